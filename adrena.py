@@ -1,16 +1,20 @@
 from collections import namedtuple
-from datetime import datetime
+import gzip
+import io
 import os
-import multiprocessing
-from tqdm import tqdm
-
-import pandas as pd
-from dateutil import parser
 
 # import chardet
 
-from zipping_files import un_gzip_to_memory
+from record_scanner import RecordScanner, map_file, read_gzip
+from extraction_plan import ExtractionPlan, compile_plan, project_plan
+from field_maps import FIELD_MAPS, INT_FIELDS, FieldMap, detect_field_map
+from timestamps import parse_day, parse_time, to_datetime64, to_nanoseconds, utc_nanoseconds
+from track_blocks import TrackBlocks
 from dif_func import progress_bar, benchmark
+from instrumentation import count, stage
+
+# pandas and the parse engine (columnar_parser, track_schema) are imported by the parsing methods, so
+# opening a track for its header or first records does not load them.
 
 Field = namedtuple('Field', ['number', 'long_name', 'middle_name', 'short_name', 'some_1', 'units', 'some_2',
                              'some_3'])
@@ -35,11 +39,11 @@ class AdrenaTrack:
 
     @staticmethod
     def pars_utc_date(v):
-        return parser.parse(v[0:v.find(' ')], dayfirst=True).date()
+        return parse_day(v[0:v.find(' ')])
 
     @staticmethod
     def parse_date(v):
-        return parser.parse(v, dayfirst=True).date()
+        return parse_day(v)
 
     @staticmethod
     def parse_lat_lon(v):
@@ -49,10 +53,10 @@ class AdrenaTrack:
         return res
 
     def parse_utc_time(self, v):
-        return datetime.strptime(v[v.find(' ') + 1:], self.time_format).time()
+        return parse_time(v[v.find(' ') + 1:], self.time_format)
 
     def parse_local_time(self, v):
-        return datetime.strptime(v, self.time_format).time()
+        return parse_time(v, self.time_format)
 
     def parse_lat(self, v):
         return -self.parse_lat_lon(v) if v[-1:] in ("S", "s") else self.parse_lat_lon(v)
@@ -60,11 +64,10 @@ class AdrenaTrack:
     def parse_lon(self, v):
         return -self.parse_lat_lon(v) if v[-1:] in ("W", "w") else self.parse_lat_lon(v)
 
-    def __init__(self, inp_file_name: str, out_path: str = ""):
+    def __init__(self, inp_file_name: str, out_path: str = "", stream: bool = False, verbose: bool = True,
+                 version: int | None = None):
         self.time_format = "%H:%M:%S"
         self.linesep = '\n'
-        self.start_index_xdr_fields = 47  # for version 17
-        self.start_index_xdr_fields = 47  # for version 20
         self.out_path = out_path
         self.inp_file_name: str = inp_file_name
         file_name = os.path.basename(self.inp_file_name)
@@ -90,22 +93,8 @@ class AdrenaTrack:
         #                        polar_bsp=115,
         #                        polar_perf=117, wa_to_mast=119, bow_lat=121, bow_lon=123, dead_reckon_bearing=125,
         #                        dead_reckon_dist=127, heel=129, mwa=131, mws=133, optimum_wa=135, pith_rate=137)
-        self.int_fields = (
-            'cog', 'heading_true', 'twd', 'awa', 'twa', 'cur_dir', 'tide_percent', 'pos_quality', 'pos_integrity',
-            'sats_view', 'sdgps_status', 'gps_fix_type')
-
-        self.static_fields_pos = dict(utc_date=1, utc_time=1, lat=(3, 4), lon=(5, 6), sog=8, cog=10, bsp=12,
-                                      heading_true=14, twd=16,
-                                      awa=18, aws=20, twa=22, tws=24, depth=26, vmg=28, local_date=31, local_time=32,
-                                      atm_pressure=38,
-                                      air_temp=40, water_temp=42, cur_speed=229, cur_dir=230, tide_height=236,
-                                      tide_percent=237)
-        self.static_fields_pos = dict(utc_date=1, utc_time=1, lat=(3, 4), lon=(5, 6), sog=8, cog=10, bsp=12,
-                                      heading_true=14, twd=16,
-                                      awa=18, aws=20, twa=22, tws=24, depth=26, vmg=28, local_date=31, local_time=32,
-                                      atm_pressure=38,
-                                      air_temp=40, water_temp=42, cur_speed=296, cur_dir=297, tide_height=303,
-                                      tide_percent=304)  # for version 20
+        self.int_fields = INT_FIELDS
+
         self.conversion_map = {
             'utc_date': self.pars_utc_date,
             'utc_time': self.parse_utc_time,
@@ -114,42 +103,63 @@ class AdrenaTrack:
             'local_date': self.parse_date,
             'local_time': self.parse_local_time,
         }
-        self.xdr_fields = dict()
-        if self.inp_file_name.endswith("trz") or self.inp_file_name.endswith("jtz"):
-            self.text: str = self.read_track_from_trz()
-        elif self.inp_file_name.endswith("trc"):
-            self.text: str = self.read_track_from_trc()
-        else:
+        # Converters by the converter kind of the extraction plan
+        self.row_converters = dict(self.conversion_map, int=int, float=float)
+        # Static field positions differ between Adrena versions, the field map is detected from the first
+        # records unless the version is given
+        self.requested_version = version
+        self.apply_field_map(FIELD_MAPS[version if version is not None else max(FIELD_MAPS)])
+        # In stream mode a compressed file is never held in memory, it is decompressed line by line on demand.
+        # Otherwise the records are found on the bytes by a RecordScanner and decoded one by one, a .trc file
+        # is memory mapped (also in stream mode) and never read nor decoded as a whole.
+        # An indexed track has no scanner of the whole file, each block is inflated and scanned when needed
+        self.stream = stream
+        self.scanner: RecordScanner | None = None
+        if not (self.is_gzipped() or self.inp_file_name.endswith("trc") or self.is_indexed()):
             print("Unknown file type!")
             exit(100)
-        self.read_xdr_headers()
-
-    def read_track_from_trz(self) -> str | None:
+        # Indexed tracks are read block by block, only the blocks of a time window when one is asked
+        self.blocks = TrackBlocks(self.inp_file_name) if self.is_indexed() else None
+        if not self.is_indexed() and (not self.stream or self.inp_file_name.endswith("trc")):
+            buffer = self.read_buffer()
+            if buffer is not None:
+                self.scanner = RecordScanner(buffer, self.linesep.encode('Latin-1'))
+        self.read_xdr_headers(show=verbose)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Release the scanner buffer, the memory map of a .trc file is unmapped here and not when (if ever)
+        the track is garbage collected """
+        if self.scanner is not None:
+            self.scanner.close()
+            self.scanner = None
+
+    def is_gzipped(self) -> bool:
+        return self.inp_file_name.endswith("trz") or self.inp_file_name.endswith("jtz")
+
+    def is_indexed(self) -> bool:
+        return self.inp_file_name.endswith("trx")
+
+    def read_buffer(self):
+        """ Decompressed bytes of the track, for a .trc file a memory map of it """
         try:
-            bytes_values = un_gzip_to_memory(self.inp_file_name)
-            # result = chardet.detect(bytes_values)
-            # encoding = result['encoding']
-            encoding = 'Latin-1'
-            txt_file = bytes_values.decode(encoding)
-
+            if self.is_gzipped():
+                with stage('gunzip'):
+                    buffer = read_gzip(self.inp_file_name)
+                count('bytes_decompressed', len(buffer))
+                return buffer
+            with stage('read_file'):
+                buffer = map_file(self.inp_file_name)
+            count('bytes_read', len(buffer))
+            return buffer
         except Exception as e:
             print(e)
             return
-        return txt_file
-
-    def read_track_from_trc(self) -> str | None:
-        try:
-            with open(self.inp_file_name, "rb") as f:
-                bytes_values = f.read()
-            # result = chardet.detect(bytes_values)
-            # encoding = result['encoding']
-            encoding = 'Latin-1'
-            txt_file = bytes_values.decode(encoding)
-
-        except Exception as e:
-            print(e)
-            return
-        return txt_file
 
     # def just_investigate(self, show: bool):
     #     """ Attempt to figure out fields in trz file"""
@@ -165,57 +175,132 @@ class AdrenaTrack:
     #         count += 1
     #     print(fields)
 
-    def read_xdr_headers(self, show: bool = True):
-        raw_lines = self.text.split(self.linesep)
-        for line in raw_lines:
-            if line[0:line.find(',')] == 'VarXdr':
-                _, *sentences = line.split(",")
-                sublists = divide_list_into_sublists(sentences, 8)
-                self.xdr_fields = [Field(lc[0], lc[1], lc[2], lc[3], lc[4], lc[5], lc[6], lc[7]) for lc in sublists]
-                if show:
-                    for ind, field in enumerate(self.xdr_fields):
-                        print(ind, field)
+    def iter_lines(self, start=None, end=None):
+        """ Lines of the track, decompressed and decoded incrementally in stream mode.
+        With start or end, an indexed track gives only the lines of its blocks that overlap the window """
+        if self.blocks is not None:
+            yield from self.blocks.iter_lines(start, end)
+            return
+        if self.scanner is not None:
+            yield from self.scanner.iter_lines()
+            return
+        binary = gzip.open(self.inp_file_name, 'rb') if self.is_gzipped() else open(self.inp_file_name, 'rb')
+        with io.TextIOWrapper(binary, encoding='Latin-1', newline=self.linesep) as text_file:
+            for line in text_file:
+                yield line[:-1] if line.endswith(self.linesep) else line
+
+    def set_xdr_fields(self, line: str, show: bool = False):
+        _, *sentences = line.split(",")
+        sublists = divide_list_into_sublists(sentences, 8)
+        self.xdr_fields = [Field(lc[0], lc[1], lc[2], lc[3], lc[4], lc[5], lc[6], lc[7]) for lc in sublists]
+        self.plan = self.compile_plan()
+        if show:
+            for ind, field in enumerate(self.xdr_fields):
+                print(ind, field)
+
+    def compile_plan(self) -> ExtractionPlan:
+        return compile_plan(self.static_fields_pos, self.xdr_fields, self.start_index_xdr_fields, self.int_fields,
+                            tuple(self.conversion_map))
+
+    def apply_field_map(self, field_map: FieldMap):
+        self.field_map_version = field_map.version
+        self.static_fields_pos = field_map.static_fields_pos
+        self.start_index_xdr_fields = field_map.start_index_xdr_fields
+        self.plan = self.compile_plan()
+
+    def field_map_evidence(self, field_map: FieldMap, records: list, names: tuple) -> tuple:
+        """ (fields, failures): number of the named static fields of the map with a value that converts in the
+        records, and of the non empty values that do not convert """
+        plan = compile_plan(field_map.static_fields_pos, [], field_map.start_index_xdr_fields, self.int_fields,
+                            tuple(self.conversion_map))
+        columns = [column for column in plan.static_columns if column.name in names]
+        converted = set()
+        failures = 0
+        for record in records:
+            data = record.split(',')
+            for column in columns:
+                if len(data) < max(column.min_length, max(column.positions) + 1) or \
+                        any(data[i] == '' for i in column.positions):
+                    continue
+                try:
+                    self.row_converters[column.kind](''.join(' ' + data[i] for i in column.positions)
+                                                     if len(column.positions) == 2 else data[column.positions[0]])
+                    converted.add(column.name)
+                except (ValueError, TypeError, IndexError):
+                    failures += 1
+        return len(converted), failures
+
+    def read_xdr_headers(self, show: bool = True, sample_size: int = 20):
+        """ One pass over the start of the file for the VarXdr header and the records to detect the version """
+        if self.blocks is not None:
+            # The header is in the footer, the sample in the first block
+            records = self.block_records(self.blocks.blocks[:1], sample_size)
+            self.apply_header(self.blocks.header, records, show)
+            return
+        if self.scanner is not None:
+            # Only the chunks up to the header and the sample are scanned
+            records = self.scanner.lines(b'$TANAV', limit=sample_size)
+            self.apply_header(self.scanner.first(b'VarXdr'), records, show)
+            return
+        xdr_line = None
+        records = []
+        for line in self.iter_lines():
+            record_type = line[0:line.find(',')]
+            if record_type == 'VarXdr' and xdr_line is None:
+                xdr_line = line
+            elif record_type == '$TANAV' and len(records) < sample_size:
+                records.append(line)
+            if xdr_line is not None and len(records) == sample_size:
                 break
+        self.apply_header(xdr_line, records, show)
 
-    def show_all_fields_index(self, lines_number):
+    def block_records(self, blocks: list, limit: int | None = None) -> list:
+        linesep = self.linesep.encode('Latin-1')
+        return RecordScanner(self.blocks.read_blocks(blocks), linesep).lines(b'$TANAV', limit) if blocks else []
 
-        raw_lines = self.text.split(self.linesep)
-        lines = []
-        for line in raw_lines:
+    def apply_header(self, xdr_line: str | None, records: list, show: bool = False):
+        if self.requested_version is None and records:
+            self.apply_field_map(detect_field_map(records, self.field_map_evidence))
+        if xdr_line is not None:
+            self.set_xdr_fields(xdr_line, show)
+
+    def show_all_fields_index(self, lines_number):
+        ind = 0
+        for line in self.iter_lines():
             if line[0:line.find(',')] == '$TANAV':
-                lines.append(line)
-        for ind, line in enumerate(lines):
-            if ind == lines_number - 1:
-                for index, value in enumerate(line.split(',')):
-                    print(index, value, sep='/t')
-                break
+                ind += 1
+                if ind == lines_number:
+                    for index, value in enumerate(line.split(',')):
+                        print(index, value, sep='/t')
+                    break
 
     def pars_row_data(self, data_line: str) -> dict:
         data = data_line.split(',')
+        length = len(data)
+        converters = self.row_converters
 
         row = dict()
-        for key, value in self.static_fields_pos.items():
-            if type(value) == tuple:
-                val = ""
-                for i in value:
-                    val += ' ' + data[i]
+        for column in self.plan.static_columns:
+            if length < column.min_length:
+                continue
+            if len(column.positions) == 1:
+                val = data[column.positions[0]]
             else:
-                if value >= len(data) - 1:
-                    continue
-                val = data[value]
-            value = self.pars_field(key, val)
-            # if value is None:
-            #     print(f"Line {data[1]} ")
-            row[key] = value
-        for index, field in enumerate(self.xdr_fields):
-            position = self.start_index_xdr_fields + index * 2
-            if field.short_name in row.keys() or field.short_name == '' or position + 1 >= len(data) - 1:
+                val = ''.join(' ' + data[i] for i in column.positions)
+            try:
+                row[column.name] = converters[column.kind](val)
+            except (ValueError, TypeError):
+                row[column.name] = None
+        for column in self.plan.xdr_columns:
+            if length < column.min_length or (column.fallback and column.name in row):
                 continue
-
-            if data[position + 1] in ('N', ''):
-                row[field.short_name] = None
+            if data[column.flag] in ('N', ''):
+                row[column.name] = None
             else:
-                row[field.short_name] = self.pars_field(field.short_name, data[position])
+                try:
+                    row[column.name] = converters[column.kind](data[column.position])
+                except (ValueError, TypeError):
+                    row[column.name] = None
         return row
 
     def pars_field(self, field_name, value, verbose: bool = False):
@@ -229,58 +314,147 @@ class AdrenaTrack:
                 print(f"{field_name} can't be converted")
             return None
 
-    def trz_parsing(self, tasks: int, show_progress: bool):
-        raw_lines = self.text.split(self.linesep)
+    def tanav_lines(self, start=None, end=None) -> list:
+        """ $TANAV records, with start or end only the ones of that UTC window (both included), decided on the
+        raw date/time field. A record with a date/time that does not parse is outside any window """
+        start_ns, end_ns = to_nanoseconds(start), to_nanoseconds(end)
+        window = start_ns is not None or end_ns is not None
         lines = []
-        for line in raw_lines:
-            if line[0:line.find(',')] == '$TANAV':
-                lines.append(line)
-        if tasks > 0:
-            pool = multiprocessing.Pool(processes=tasks)
-
-            if show_progress:
-                chunk_size = 1000  # Number of lines per chunk
-                chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
-                total_chunks = len(chunks)
-
-                # Initialize the progress bar
-                progress_bar_tq = tqdm(total=total_chunks * chunk_size, desc='Progress')
-                parsed_results = []
-                for chunk in chunks:
-                    chunk_results = pool.map(self.pars_row_data, chunk)
-                    parsed_results.extend(chunk_results)
-                    progress_bar_tq.update(chunk_size)  # Update the progress bar for each chunk
-
-                progress_bar_tq.close()
-                # *********************************************************************
+        with stage('tanav_lines'):
+            if self.blocks is not None:
+                # Only the blocks of the window are inflated, one at a time
+                records = (line for block in self.blocks.select(start, end) for line in self.block_records([block]))
+            elif self.scanner is not None:
+                records = self.scanner.lines(b'$TANAV')
+            else:
+                records = (line for line in self.iter_lines(start, end) if line[0:line.find(',')] == '$TANAV')
+            if not window:
+                lines = list(records)
             else:
-                # With out progress bar **********************
-                parsed_results = pool.map(self.pars_row_data, lines)
-                # *************************************************************
-            pool.close()
-            pool.join()
+                for line in records:
+                    begin = line.find(',') + 1
+                    stop = line.find(',', begin)
+                    time_ns = utc_nanoseconds(line[begin:stop] if stop >= 0 else line[begin:], self.time_format)
+                    if time_ns is None or (start_ns is not None and time_ns < start_ns) or \
+                            (end_ns is not None and time_ns > end_ns):
+                        continue
+                    lines.append(line)
+        count('lines', len(lines))
+        return lines
+
+    def raw_bytes(self) -> bytes:
+        """ Decompressed track, the scanner buffer (a memory map for .trc) when there is one """
+        if self.scanner is not None:
+            return self.scanner.buffer
+        if self.is_indexed():
+            return self.blocks.read_bytes()
+        if self.is_gzipped():
+            with stage('gunzip'):
+                return read_gzip(self.inp_file_name)
+        with stage('read_file'), open(self.inp_file_name, "rb") as f:
+            return f.read()
+
+    def field_map(self) -> dict:
+        return dict(plan=self.plan, time_format=self.time_format, linesep=self.linesep)
+
+    def trz_parsing(self, tasks: int, show_progress: bool):
+        if tasks > 0:
+            # Workers get the field map once and byte ranges of the shared track, not this object
+            from columnar_parser import parse_records_parallel
+            data = self.raw_bytes()
+            with stage('parallel_parse'):
+                df = parse_records_parallel(data, self.field_map(), tasks, show_progress)
         else:
             # VAR consecutive *****************************************
+            lines = self.tanav_lines()
             parsed_results = []
             total = len(lines)
-            for ind, line in enumerate(lines):
-                parsed_results.append(self.pars_row_data(line))
-                if show_progress:
-                    progress_bar(ind, total, prefix='Progress:', suffix='Complete', length=30)
+            with stage('row_parse'):
+                for ind, line in enumerate(lines):
+                    parsed_results.append(self.pars_row_data(line))
+                    if show_progress:
+                        progress_bar(ind, total, prefix='Progress:', suffix='Complete', length=30)
             # VAR consecutive *****************************************
-        df = pd.DataFrame(parsed_results)
-        df['utc_datetime'] = pd.to_datetime(df['utc_date'].astype(str) + ' ' + df['utc_time'].astype(str))
+            import pandas as pd
+            with stage('dataframe'):
+                df = pd.DataFrame(parsed_results)
+        count('rows', len(df))
+        df['utc_datetime'] = to_datetime64(df['utc_date'].to_numpy(), df['utc_time'].to_numpy())
+
+        return df
+
+    def columnar_parsing(self, lines: list | None = None):
+        """ Same result as trz_parsing(tasks=0), but converts whole columns at once """
+        from columnar_parser import parse_records
+        if lines is None:
+            lines = self.tanav_lines()
+        df = parse_records(lines, self.plan, self.time_format)
+        df['utc_datetime'] = to_datetime64(df['utc_date'].to_numpy(), df['utc_time'].to_numpy())
 
         return df
 
+    def read(self, columns: list | None = None, start=None, end=None, compact: bool = False) -> 'pd.DataFrame':
+        """ Records between start and end (UTC, anything pd.Timestamp takes) with only the columns asked
+        and utc_datetime. The window is applied to the raw lines and only the asked columns are converted,
+        an indexed track inflates only the blocks of the window. compact gives the track_schema dtypes.
+        Every asked column is returned, also when no record of the window has it (or there is none), a name
+        the track can not have is a KeyError """
+        import pandas as pd
+        from columnar_parser import add_plan_columns, parse_records
+        from track_schema import compact_track
+        plan = self.plan
+        if columns is not None:
+            known = set(column.name for column in self.plan.static_columns + self.plan.xdr_columns)
+            unknown = [column for column in columns
+                       if column not in known and column not in self.static_fields_pos and column != 'utc_datetime']
+            if unknown:
+                raise KeyError(f"{', '.join(unknown)} not in the fields of {self.inp_file_name}")
+            plan = project_plan(self.plan, tuple(columns) + ('utc_date', 'utc_time'))
+        df = add_plan_columns(parse_records(self.tanav_lines(start, end), plan, self.time_format), plan)
+        if 'utc_date' in df.columns and 'utc_time' in df.columns:
+            df['utc_datetime'] = to_datetime64(df['utc_date'].to_numpy(), df['utc_time'].to_numpy())
+        else:
+            df['utc_datetime'] = pd.Series(dtype='datetime64[ns]')
+        if columns is not None:
+            df = df[[column for column in dict.fromkeys(columns) if column != 'utc_datetime'] + ['utc_datetime']]
+        return compact_track(df, self.int_fields) if compact else df
+
+    def iter_chunks(self, chunk_size: int = 10000):
+        """ Parse the track in DataFrames of chunk_size records, memory stays flat in stream mode """
+        xdr_header_found = False
+        lines = []
+        offset = 0
+        for line in self.iter_lines():
+            record_type = line[0:line.find(',')]
+            if record_type == '$TANAV':
+                lines.append(line)
+                if len(lines) == chunk_size:
+                    df = self.columnar_parsing(lines)
+                    df.index += offset
+                    offset += len(lines)
+                    lines = []
+                    yield df
+            elif record_type == 'VarXdr' and not xdr_header_found:
+                # The header may change the columns, so records before it go out with the previous layout
+                if lines:
+                    df = self.columnar_parsing(lines)
+                    df.index += offset
+                    offset += len(lines)
+                    lines = []
+                    yield df
+                self.set_xdr_fields(line)
+                xdr_header_found = True
+        if lines:
+            df = self.columnar_parsing(lines)
+            df.index += offset
+            yield df
+
 
 def convert_file(inp_file, out_path):
     track = AdrenaTrack(inp_file, out_path)
     print(f' File {track.inp_file_name} read!')
-    track.show_all_fields_index(1)
     print('Parsing data...')
-    df = track.trz_parsing(0, False)
-    df['utc_datetime'] = pd.to_datetime(df['utc_date'].astype(str) + ' ' + df['utc_time'].astype(str))
+    df = track.columnar_parsing()
     df.to_csv(track.out_file)
     print(df.info())
 
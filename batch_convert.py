@@ -0,0 +1,136 @@
+import argparse
+import fnmatch
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from adrena import AdrenaTrack
+from derived import DERIVED, DerivedChannels
+from track_schema import compact_track
+
+# Convert a directory of Adrena tracks into analysis files, several files at a time:
+# python batch_convert.py input_dir output_dir [--glob "*.trz"] [--format parquet] [--jobs 8]
+
+TRACK_PATTERNS = ('*.trc', '*.trz', '*.jtz', '*.trx')
+FORMATS = {'parquet': '.parquet', 'csv.gz': '.csv.gz', 'csv': '.csv'}
+
+
+def file_hash(file_name: str) -> str:
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def output_name(inp_file: str, out_path: str, out_format: str) -> str:
+    file_name_without_extension = os.path.splitext(os.path.basename(inp_file))[0]
+    return os.path.join(out_path, file_name_without_extension + FORMATS[out_format])
+
+
+def is_up_to_date(inp_file: str, out_file: str, check: str) -> bool:
+    if not os.path.exists(out_file):
+        return False
+    if check == 'hash':
+        try:
+            with open(out_file + '.sha1') as f:
+                return f.read().strip() == file_hash(inp_file)
+        except OSError:
+            return False
+    return os.path.getmtime(out_file) >= os.path.getmtime(inp_file)
+
+
+def convert_one(inp_file: str, out_file: str, out_format: str, check: str, raw: bool = False,
+                derived: tuple = ()) -> dict:
+    start = time.perf_counter()
+    with AdrenaTrack(inp_file, stream=True, verbose=False) as track:
+        df = track.columnar_parsing()
+    if not raw:
+        df = compact_track(df, track.int_fields)
+    if derived:
+        df = DerivedChannels(df).frame(list(df.columns) + list(derived))
+    parsed = time.perf_counter()
+
+    tmp_file = out_file + '.tmp'
+    if out_format == 'parquet':
+        df.to_parquet(tmp_file)
+    else:
+        df.to_csv(tmp_file, compression='gzip' if out_format == 'csv.gz' else None)
+    os.replace(tmp_file, out_file)
+    if check == 'hash':
+        with open(out_file + '.sha1', 'w') as f:
+            f.write(file_hash(inp_file))
+    return dict(file=inp_file, rows=len(df), in_bytes=os.path.getsize(inp_file), out_bytes=os.path.getsize(out_file),
+                parse_s=parsed - start, total_s=time.perf_counter() - start)
+
+
+def find_tracks(input_directory: str, pattern: str | None) -> list:
+    patterns = (pattern,) if pattern else TRACK_PATTERNS
+    return sorted(os.path.join(input_directory, f) for f in os.listdir(input_directory)
+                  if any(fnmatch.fnmatch(f, p) for p in patterns)
+                  and os.path.isfile(os.path.join(input_directory, f)))
+
+
+def batch_convert(input_directory: str, out_path: str, pattern: str | None = None, out_format: str = 'parquet',
+                  jobs: int | None = None, check: str = 'mtime', force: bool = False, raw: bool = False,
+                  derived: tuple = ()) -> list:
+    os.makedirs(out_path, exist_ok=True)
+    todo = []
+    for inp_file in find_tracks(input_directory, pattern):
+        out_file = output_name(inp_file, out_path, out_format)
+        if force or not is_up_to_date(inp_file, out_file, check):
+            todo.append((inp_file, out_file))
+        else:
+            print(f'{inp_file} is up to date, skipped')
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as exe:
+        futures = {exe.submit(convert_one, inp_file, out_file, out_format, check, raw, derived): inp_file
+                   for inp_file, out_file in todo}
+        for future in as_completed(futures):
+            try:
+                res = future.result()
+            except Exception as e:
+                print(f'{futures[future]} failed: {e}')
+                continue
+            print(f'.converted {res["file"]}')
+            results.append(res)
+    return results
+
+
+def report(results: list, elapsed: float):
+    for res in sorted(results, key=lambda r: r['file']):
+        print(f"{os.path.basename(res['file'])}: {res['rows']} rows in {res['total_s']:.2f} s, "
+              f"{res['rows'] / res['total_s']:.0f} rows/s, {res['in_bytes'] / res['total_s'] / 1e6:.2f} MB/s")
+    rows = sum(res['rows'] for res in results)
+    in_bytes = sum(res['in_bytes'] for res in results)
+    if elapsed > 0:
+        print(f"Total: {len(results)} files, {rows} rows in {elapsed:.2f} s, "
+              f"{rows / elapsed:.0f} rows/s, {in_bytes / elapsed / 1e6:.2f} MB/s")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Convert Adrena tracks of a directory in parallel')
+    arg_parser.add_argument('input_directory')
+    arg_parser.add_argument('out_path')
+    arg_parser.add_argument('--glob', default=None, help='file name pattern, all .trc/.trz/.jtz/.trx files by default')
+    arg_parser.add_argument('--format', default='parquet', choices=FORMATS.keys())
+    arg_parser.add_argument('--jobs', type=int, default=None, help='worker processes, all cores by default')
+    arg_parser.add_argument('--check', default='mtime', choices=('mtime', 'hash'),
+                            help='how to decide that an output file is up to date')
+    arg_parser.add_argument('--force', action='store_true', help='convert up to date files too')
+    arg_parser.add_argument('--raw', action='store_true',
+                            help='keep the parsed dtypes (date/time objects, float64) instead of the compact schema')
+    arg_parser.add_argument('--derived', default='',
+                            help=f"derived channels to add, comma separated: {', '.join(DERIVED)}")
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    results = batch_convert(args.input_directory, args.out_path, args.glob, args.format, args.jobs, args.check,
+                            args.force, args.raw, tuple(name for name in args.derived.split(',') if name))
+    report(results, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
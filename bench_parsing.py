@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from adrena import AdrenaTrack
+from field_maps import FIELD_MAPS, INT_FIELDS, required_length
+
+try:
+    import resource  # not on Windows, peak RSS is then not reported
+except ImportError:
+    resource = None
+
+
+# Compare the row by row parser with the columnar one on real tracks:
+# python bench_parsing.py track1.trz [track2.trc ...]
+# Benchmark suite on synthetic tracks, one JSON record per run (appended to --json when given):
+# python bench_parsing.py --suite [--versions 17 20] [--formats trc trz] [--duration 3600] [--rate 1]
+#                         [--channels 100] [--modes sequential multiprocessing streaming cache-hit] [--json runs.json]
+# Cold start of the entry points, each imported in a fresh interpreter:
+# python bench_parsing.py --startup [--json runs.json]
+
+MODES = ('sequential', 'multiprocessing', 'streaming', 'cache-hit')
+STARTUP_MODULES = ('adrena', 'track_cache', 'live_track', 'ingest_service', 'fleet', 'main')
+HEAVY_MODULES = ('pandas', 'pyarrow', 'streamlit', 'altair', 'ftputil', 'dateutil', 'multiprocessing.shared_memory',
+                 'tqdm')
+
+
+def bench_file(file_name: str, repeat: int = 1) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        track = AdrenaTrack(file_name)
+    timings = dict()
+    results = dict()
+    for name, parse in (('rows', lambda: track.trz_parsing(tasks=0, show_progress=False)),
+                        ('columnar', track.columnar_parsing)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results[name] = parse()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    pd.testing.assert_frame_equal(results['rows'], results['columnar'])
+    return dict(file=file_name, rows=len(results['rows']), columns=len(results['rows'].columns),
+                rows_s=timings['rows'], columnar_s=timings['columnar'],
+                speedup=timings['rows'] / timings['columnar'])
+
+
+# Synthetic tracks ****************************************************************************
+def write_synthetic_track(path: str, version: int = 20, duration_s: int = 3600, rate_hz: float = 1.0,
+                          xdr_channels: int = 100, seed: int = 0) -> str:
+    """ Adrena track with the static fields of the version and xdr_channels XDR channels, gzipped for .trz """
+    rnd = random.Random(seed)
+    field_map = FIELD_MAPS[version]
+    start = field_map.start_index_xdr_fields
+    width = max(start + 2 * xdr_channels + 1, required_length(field_map))
+    header = 'VarXdr,' + ','.join(f'{i},Channel {i},Ch {i},X{i:03d},2,kt,9,10' for i in range(xdr_channels))
+    t0 = datetime.datetime(2023, 7, 22, 10, 0, 0)
+    lines = [header]
+    for i in range(int(duration_s * rate_hz)):
+        utc = t0 + datetime.timedelta(seconds=i / rate_hz)
+        local = utc + datetime.timedelta(hours=2)
+        cells = [''] * width
+        cells[0] = '$TANAV'
+        for channel in range(xdr_channels):
+            cells[start + 2 * channel] = f'{rnd.uniform(0, 100):.2f}'
+            cells[start + 2 * channel + 1] = 'N' if rnd.random() < 0.05 else 'A'
+        for name, position in field_map.static_fields_pos.items():
+            if type(position) == tuple:
+                degrees = 50 if name == 'lat' else 4
+                cells[position[0]] = f'{degrees:0{2 if name == "lat" else 3}d}{rnd.uniform(0, 59.999):06.3f}'
+                cells[position[1]] = 'N' if name == 'lat' else 'W'
+            elif name in ('utc_date', 'utc_time'):
+                cells[position] = utc.strftime('%d/%m/%Y %H:%M:%S')
+            elif name == 'local_date':
+                cells[position] = local.strftime('%d/%m/%Y')
+            elif name == 'local_time':
+                cells[position] = local.strftime('%H:%M:%S')
+            elif name in INT_FIELDS:
+                cells[position] = str(rnd.randint(0, 359))
+            else:
+                cells[position] = f'{rnd.uniform(0, 30):.2f}'
+        lines.append(','.join(cells))
+    data = ('\n'.join(lines) + '\n').encode('Latin-1')
+    with (gzip.open(path, 'wb') if path.endswith(('.trz', '.jtz')) else open(path, 'wb')) as f:
+        f.write(data)
+    return path
+
+
+# Cold start **********************************************************************************
+def startup_time(module: str, repeat: int = 3) -> dict:
+    """ Best import time of module in fresh interpreters and the heavy dependencies it loads """
+    code = (f"import json, sys, time\nstart = time.perf_counter()\nimport {module}\n"
+            f"print(json.dumps([time.perf_counter() - start, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, loaded = json.loads(result.stdout.strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return dict(module=module, seconds=best, loaded=loaded)
+
+
+def run_startup(modules=STARTUP_MODULES, repeat: int = 3) -> dict:
+    results = []
+    for module in modules:
+        res = startup_time(module, repeat)
+        print(f"{module}: {res['seconds']:.3f} s, loads {', '.join(res['loaded']) or 'no heavy module'}",
+              file=sys.stderr)
+        results.append(res)
+    return dict(time=datetime.datetime.now().isoformat(timespec='seconds'), python=platform.python_version(),
+                platform=platform.platform(), startup=results)
+
+
+# Suite ***************************************************************************************
+def peak_rss_mb(children: bool = False) -> float | None:
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return usage.ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run_mode(mode: str, file_name: str, tasks: int, cache_dir: str) -> dict:
+    """ One mode on one file, run in a fresh process so that its peak RSS is its own """
+    from track_cache import TrackCache
+
+    start = time.perf_counter()
+    if mode == 'sequential':
+        rows = len(AdrenaTrack(file_name, verbose=False).columnar_parsing())
+    elif mode == 'multiprocessing':
+        rows = len(AdrenaTrack(file_name, verbose=False).trz_parsing(tasks, show_progress=False))
+    elif mode == 'streaming':
+        rows = sum(len(df) for df in AdrenaTrack(file_name, stream=True, verbose=False).iter_chunks())
+    elif mode in ('cache-fill', 'cache-hit'):
+        rows = len(TrackCache(cache_dir).parse(file_name))
+    else:
+        raise ValueError(f"Unknown mode {mode}")
+    seconds = time.perf_counter() - start
+    return dict(mode=mode, rows=rows, seconds=seconds, peak_rss_mb=peak_rss_mb(),
+                workers_peak_rss_mb=peak_rss_mb(children=True))
+
+
+def run_isolated(*args) -> dict:
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as exe:
+        return exe.submit(run_mode, *args).result()
+
+
+def run_suite(versions=(17, 20), formats=('trc', 'trz'), duration_s: int = 3600, rate_hz: float = 1.0,
+              xdr_channels: int = 100, modes=MODES, tasks: int | None = None) -> dict:
+    tasks = tasks or os.cpu_count()
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for version in versions:
+            for file_format in formats:
+                file_name = write_synthetic_track(os.path.join(work_dir, f'v{version}.{file_format}'), version,
+                                                  duration_s, rate_hz, xdr_channels)
+                file_mb = os.path.getsize(file_name) / 1e6
+                with contextlib.redirect_stdout(io.StringIO()):
+                    raw_mb = len(AdrenaTrack(file_name, stream=True, verbose=False).raw_bytes()) / 1e6
+                cache_dir = os.path.join(work_dir, 'cache')
+                for mode in modes:
+                    if mode == 'cache-hit':
+                        run_isolated('cache-fill', file_name, tasks, cache_dir)
+                    res = run_isolated(mode, file_name, tasks, cache_dir)
+                    res.update(version=version, format=file_format, file_mb=file_mb, raw_mb=raw_mb,
+                               rows_per_s=res['rows'] / res['seconds'], mb_per_s=file_mb / res['seconds'],
+                               raw_mb_per_s=raw_mb / res['seconds'])
+                    print(f"v{version} {file_format} {mode}: {res['rows']} rows in {res['seconds']:.2f} s, "
+                          f"{res['rows_per_s']:.0f} rows/s, {res['raw_mb_per_s']:.1f} MB/s", file=sys.stderr)
+                    results.append(res)
+    return dict(time=datetime.datetime.now().isoformat(timespec='seconds'), python=platform.python_version(),
+                platform=platform.platform(), cpus=os.cpu_count(), tasks=tasks, duration_s=duration_s,
+                rate_hz=rate_hz, xdr_channels=xdr_channels, results=results)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Adrena parser benchmarks')
+    arg_parser.add_argument('files', nargs='*', help='tracks to compare the row and the columnar parsers on')
+    arg_parser.add_argument('--suite', action='store_true', help='run the benchmark suite on synthetic tracks')
+    arg_parser.add_argument('--startup', action='store_true', help='measure the cold import of the entry points')
+    arg_parser.add_argument('--versions', type=int, nargs='+', default=[17, 20])
+    arg_parser.add_argument('--formats', nargs='+', default=['trc', 'trz'], choices=('trc', 'trz'))
+    arg_parser.add_argument('--duration', type=int, default=3600, help='seconds of track')
+    arg_parser.add_argument('--rate', type=float, default=1.0, help='records per second')
+    arg_parser.add_argument('--channels', type=int, default=100, help='XDR channels')
+    arg_parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES)
+    arg_parser.add_argument('--tasks', type=int, default=None, help='processes of the multiprocessing mode')
+    arg_parser.add_argument('--json', default=None, help='file to append the run to, one JSON record per line')
+    args = arg_parser.parse_args()
+
+    if args.suite or args.startup:
+        run = run_startup() if args.startup else \
+            run_suite(args.versions, args.formats, args.duration, args.rate, args.channels, args.modes, args.tasks)
+        if args.json:
+            with open(args.json, 'a') as f:
+                f.write(json.dumps(run) + '\n')
+        print(json.dumps(run, indent=2))
+        return
+    if not args.files:
+        arg_parser.print_help()
+        return
+    for file_name in args.files:
+        res = bench_file(file_name)
+        print(f"{res['file']}: {res['rows']} rows x {res['columns']} columns, "
+              f"rows {res['rows_s']:.3f} s, columnar {res['columnar_s']:.3f} s, speedup x{res['speedup']:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import altair as alt
+import pandas as pd
+
+from downsample import downsample_long
+
+# All panels of a track are drawn from one long format (utc_datetime, variable, value) dataset.
+# The panels are concatenated into one chart, so the Vega spec holds the data once, and the top
+# overview panel has a time brush that zooms every other panel.
+# A comparison chart draws boats aligned on one clock (fleet.align_tracks), one panel per channel and
+# one line per boat.
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def prepare_long(df: pd.DataFrame, columns: list, width: int = 600, method: str = 'min_max') -> pd.DataFrame:
+    """ Long format of the columns, once per track, each series reduced to about two points per pixel """
+    columns = [column for column in dict.fromkeys(columns) if column in df.columns]
+    long_df = downsample_long(df, 'utc_datetime', columns, 2 * width, method)
+    long_df['utc_datetime'] = long_df['utc_datetime'].dt.tz_localize('UTC')
+    return long_df
+
+
+def prepare_comparison(aligned: pd.DataFrame, columns: list, labels: dict | None = None,
+                       width: int = 600, method: str = 'min_max') -> pd.DataFrame:
+    """ Long format (utc_datetime, variable, value, boat) of aligned boats, each series downsampled """
+    labels = labels or dict()
+    parts = []
+    for boat in aligned.columns.get_level_values('boat').unique():
+        df = aligned[boat].reset_index()
+        long_df = prepare_long(df, columns, width, method)
+        long_df['boat'] = labels.get(boat, boat)
+        parts.append(long_df)
+    if not parts:
+        return pd.DataFrame(columns=['utc_datetime', 'variable', 'value', 'boat'])
+    return pd.concat(parts, ignore_index=True)
+
+
+def panel_chart(var_list: list, brush=None, width: int = 600, height: int = 250, color: str = 'variable') -> alt.Chart:
+    """ Lines of var_list, without data of its own, zoomed by the brush when given, one line per color value """
+    x = alt.X('utc_datetime:T', axis=alt.Axis(format=TIME_FORMAT, title='Your local Time'))
+    if brush is not None:
+        x = x.scale(domain=brush)
+    return alt.Chart().mark_line().encode(
+        x=x,
+        y=alt.Y('value:Q', title=', '.join(var_list), scale=alt.Scale(zero=False)),
+        color=alt.Color(f'{color}:N', legend=alt.Legend(orient='bottom')),
+        tooltip=['utc_datetime:T', 'value:Q', 'variable:N'] + ([f'{color}:N'] if color != 'variable' else [])
+    ).transform_filter(
+        alt.FieldOneOfPredicate(field='variable', oneOf=var_list)
+    ).properties(
+        width=width,
+        height=height
+    )
+
+
+def track_chart(long_df: pd.DataFrame, panels: list, width: int = 600, height: int = 250) -> alt.VConcatChart:
+    brush = alt.selection_interval(encodings=['x'])
+    overview = panel_chart(panels[0], width=width, height=60).add_params(brush).properties(
+        title='Drag to zoom all charts')
+    charts = [panel_chart(var_list, brush, width, height) for var_list in panels]
+    return alt.vconcat(overview, *charts, data=long_df).resolve_scale(y='independent', color='independent')
+
+
+def comparison_chart(long_df: pd.DataFrame, columns: list, width: int = 600, height: int = 200) -> alt.VConcatChart:
+    """ One panel per channel with a line per boat, zoomed together by the overview brush """
+    brush = alt.selection_interval(encodings=['x'])
+    overview = panel_chart(columns[:1], width=width, height=60, color='boat').add_params(brush).properties(
+        title='Drag to zoom all charts')
+    charts = [panel_chart([column], brush, width, height, color='boat') for column in columns]
+    return alt.vconcat(overview, *charts, data=long_df).resolve_scale(y='independent')
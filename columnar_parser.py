@@ -0,0 +1,295 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from extraction_plan import ExtractionPlan, XdrColumn, last_position, row_layout
+from instrumentation import count, stage
+from record_scanner import RecordScanner
+from timestamps import parse_day, parse_time
+
+# Columnar parse engine for $TANAV records.
+# All records are split once into a 2-D string table and every output column is
+# converted in one go. Every converter works on the unique values of a column only,
+# so repeated dates, headings, flags etc. are converted once.
+# The result is identical to the row by row AdrenaTrack.pars_row_data path.
+# Since the extraction plan and the date cache the row path is about as fast on one process (7200 records of
+# 125 channels in 0.39 s here vs 0.40 s, it was 2.6 times slower before them), both spend their time splitting
+# the records. This engine is kept because it gives whole numpy columns: the parallel workers send them back
+# instead of row dicts, and read() converts only the projected columns.
+
+# Bump when the parsed output changes, cached tracks of older versions are then reparsed
+PARSER_VERSION = 1
+
+NUMERIC, INTEGER, OBJECT = 'numeric', 'integer', 'object'
+KIND_DTYPES = {NUMERIC: np.float64, INTEGER: np.int64, OBJECT: object}
+
+
+def split_records(lines: list, max_split: int = -1) -> tuple:
+    """ One bulk split of all records into a padded table (None for missing cells) and the record lengths.
+    With max_split only the first max_split cells are split off, the rest of a record stays in one cell """
+    rows = [line.split(',', max_split) for line in lines]
+    cells = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    lengths = cells if max_split < 0 else \
+        np.fromiter((line.count(',') + 1 for line in lines), dtype=np.int64, count=len(lines))
+    width = int(cells.max()) if len(rows) else 0
+    table = np.full((len(rows), width), None, dtype=object, order='F')
+    for n in pd.unique(cells):
+        index = np.flatnonzero(cells == n)
+        table[index, :n] = np.array([rows[i] for i in index], dtype=object).reshape(len(index), n)
+    return table, lengths
+
+
+def _convert_unique(values: np.ndarray, func, dtype=object) -> tuple:
+    """ Convert the unique values with func, return converted values and success mask """
+    codes, uniques = pd.factorize(values)
+    converted = np.empty(len(uniques) + 1, dtype=dtype)
+    ok = np.zeros(len(uniques) + 1, dtype=bool)
+    for i, value in enumerate(uniques):
+        try:
+            converted[i] = func(value)
+            ok[i] = True
+        except (ValueError, TypeError):
+            converted[i] = np.nan if dtype != object else None
+    converted[-1] = np.nan if dtype != object else None
+    return converted[codes], ok[codes]
+
+
+def to_float(values: np.ndarray) -> tuple:
+    codes, uniques = pd.factorize(values)
+    try:
+        converted = np.append(uniques.astype(np.float64), np.nan)
+        ok = np.ones(len(converted), dtype=bool)
+        ok[-1] = False
+        return converted[codes], ok[codes]
+    except (ValueError, TypeError):
+        return _convert_unique(values, float, np.float64)
+
+
+def to_int(values: np.ndarray) -> tuple:
+    codes, uniques = pd.factorize(values)
+    try:
+        converted = np.append(uniques.astype(np.int64), 0)
+        ok = np.ones(len(converted), dtype=bool)
+        ok[-1] = False
+        return converted[codes], ok[codes]
+    except (ValueError, TypeError, OverflowError):
+        return _convert_unique(values, int, object)
+
+
+def _join_lat_lon(values: np.ndarray, hemispheres: np.ndarray) -> np.ndarray:
+    return np.array([' ' + v + ' ' + h for v, h in zip(values, hemispheres)], dtype=object)
+
+
+def to_degrees(values: np.ndarray, negative: tuple) -> tuple:
+    """ Vectorized degree-minute decode of the ' DDDMM.mmm H' string built by pars_row_data """
+    text = pd.Series(values, dtype=object)
+    degrees, degrees_ok = to_int(text.str[:-8].to_numpy(dtype=object))
+    minutes, minutes_ok = to_float(text.str[-8:-2].to_numpy(dtype=object))
+    ok = degrees_ok & minutes_ok
+    result = np.where(ok, degrees.astype(np.float64) + minutes.astype(np.float64) / 60, np.nan)
+    sign = text.str[-1:].isin(negative).to_numpy()
+    result[sign] = -result[sign]
+    return result, ok
+
+
+def date_part(v: str) -> str:
+    return v[0:v.find(' ')]
+
+
+def time_part(v: str) -> str:
+    return v[v.find(' ') + 1:]
+
+
+def make_converters(time_format: str) -> dict:
+    """ Column converters by the converter kind of the extraction plan """
+
+    def parse_hms(v):
+        return parse_time(v, time_format)
+
+    return {
+        'utc_date': lambda values: _convert_unique(_map_unique(values, date_part), parse_day),
+        'utc_time': lambda values: _convert_unique(_map_unique(values, time_part), parse_hms),
+        'lat': lambda values: to_degrees(values, ['S', 's']),
+        'lon': lambda values: to_degrees(values, ['W', 'w']),
+        'local_date': lambda values: _convert_unique(values, parse_day),
+        'local_time': lambda values: _convert_unique(values, parse_hms),
+        'int': to_int,
+        'float': to_float,
+    }
+
+
+def value_kind(converter: str) -> str:
+    if 'date' in converter or 'time' in converter:
+        return OBJECT
+    if converter == 'int':
+        return INTEGER
+    return NUMERIC
+
+
+def _map_unique(values: np.ndarray, func) -> np.ndarray:
+    codes, uniques = pd.factorize(values)
+    mapped = np.array([func(v) for v in uniques] + [None], dtype=object)
+    return mapped[codes]
+
+
+def _finish_column(values: np.ndarray, ok: np.ndarray, present: np.ndarray, kind: str):
+    """ Give the column the dtype a DataFrame built from row dicts would infer """
+    if not ok.any():
+        # Only None values stay object, NaN of the rows without the key turn it into float
+        if present.all():
+            return np.full(len(values), None, dtype=object)
+        return np.full(len(values), np.nan)
+    if kind == OBJECT:
+        return values
+    if kind == INTEGER:
+        if ok.all():
+            return values.astype(np.int64)
+        return np.where(ok, values, np.nan).astype(np.float64)
+    return np.where(ok, values, np.nan).astype(np.float64)
+
+
+def _empty_column(size: int, kind: str) -> np.ndarray:
+    return np.full(size, None if kind == OBJECT else np.nan, dtype=object if kind == OBJECT else None)
+
+
+def convert_records(lines: list, plan: ExtractionPlan, time_format: str = "%H:%M:%S") -> dict:
+    """ Converted columns of the records as column -> (values, ok, present, kind), in output order """
+    # Cells after the last one the plan reads are never split
+    with stage('split'):
+        table, lengths = split_records(lines, last_position(plan) + 1)
+    converters = make_converters(time_format)
+
+    layouts = {n: row_layout(plan, n) for n in pd.unique(lengths)}
+    columns = list(dict.fromkeys(key for layout in layouts.values() for key in layout))
+
+    data = dict()
+    for key in columns:
+        # Usually one source for all rows, but a short record can take a field from the XDR block
+        sources = dict()
+        for n, layout in layouts.items():
+            if key in layout:
+                sources.setdefault(layout[key], []).append(n)
+        converter = next(iter(sources)).kind
+        kind, convert = value_kind(converter), converters[converter]
+
+        values = _empty_column(len(lines), kind)
+        ok = np.zeros(len(lines), dtype=bool)
+        present = np.zeros(len(lines), dtype=bool)
+        for source, source_lengths in sources.items():
+            rows = np.flatnonzero(np.isin(lengths, source_lengths))
+            present[rows] = True
+            if type(source) == XdrColumn:
+                flags = table[rows, source.flag]
+                valid = ~pd.Series(flags, dtype=object).isin(['N', '']).to_numpy()
+                rows = rows[valid]
+                cells = table[rows, source.position]
+            elif len(source.positions) == 2:
+                cells = _join_lat_lon(table[rows, source.positions[0]], table[rows, source.positions[1]])
+            else:
+                cells = table[rows, source.positions[0]]
+            if len(rows) == 0:
+                continue
+            converted, converted_ok = convert(cells)
+            if kind == INTEGER and converted.dtype == object:
+                converted = np.where(converted_ok, converted, 0).astype(np.int64)
+            values[rows] = converted
+            ok[rows] = converted_ok
+        data[key] = (values, ok, present, kind)
+    return data
+
+
+def assemble(blocks: list, sizes: list) -> pd.DataFrame:
+    """ DataFrame from the converted columns of consecutive blocks of records """
+    columns = list(dict.fromkeys(key for block in blocks for key in block))
+    data = dict()
+    for key in columns:
+        kind = next(block[key][3] for block in blocks if key in block)
+        parts = [block[key] if key in block else
+                 (_empty_column(size, kind), np.zeros(size, dtype=bool), np.zeros(size, dtype=bool), kind)
+                 for block, size in zip(blocks, sizes)]
+        values, ok, present = (np.concatenate([part[i] for part in parts]) for i in range(3))
+        data[key] = _finish_column(values, ok, present, kind)
+    return pd.DataFrame(data, index=pd.RangeIndex(sum(sizes)))
+
+
+def add_plan_columns(df: pd.DataFrame, plan: ExtractionPlan) -> pd.DataFrame:
+    """ df with every output column of the plan, the ones no record had are missing values. Without rows
+    they get the dtype of their converter kind """
+    missing = dict()
+    for column in plan.static_columns + plan.xdr_columns:
+        if column.name not in df.columns and column.name not in missing:
+            kind = value_kind(column.kind)
+            missing[column.name] = np.empty(0, dtype=KIND_DTYPES[kind]) if len(df) == 0 else \
+                _empty_column(len(df), kind)
+    return pd.concat([df, pd.DataFrame(missing, index=df.index)], axis=1) if missing else df
+
+
+def parse_records(lines: list, plan: ExtractionPlan, time_format: str = "%H:%M:%S") -> pd.DataFrame:
+    with stage('columnar_parse'):  # split included
+        block = convert_records(lines, plan, time_format)
+    with stage('dataframe'):
+        df = assemble([block], [len(lines)])
+    count('rows', len(df))
+    return df
+
+
+# Parallel parsing. The decompressed track goes once into shared memory, the workers get the extraction
+# plan at start up and then only byte ranges of whole lines. They pick the $TANAV records of their range
+# and send back converted columns, not row dicts.
+# Every worker gets several ranges (RANGES_PER_TASK), so the load evens out and small tracks use all of them.
+
+RANGES_PER_TASK = 4
+
+_shared_block = None
+_worker_field_map = None
+
+
+def _init_worker(shared_name: str, field_map: dict):
+    from multiprocessing import shared_memory
+    global _shared_block, _worker_field_map
+    _shared_block = shared_memory.SharedMemory(name=shared_name)
+    _worker_field_map = field_map
+
+
+def _parse_byte_range(task: tuple) -> tuple:
+    index, start, end = task
+    field_map = dict(_worker_field_map)
+    linesep = field_map.pop('linesep')
+    lines = RecordScanner(_shared_block.buf[start:end], linesep.encode('Latin-1')).lines(b'$TANAV')
+    return index, len(lines), convert_records(lines, **field_map)
+
+
+def byte_ranges(data: bytes, linesep: bytes, block_size: int) -> list:
+    """ Ranges of about block_size bytes, cut after a line separator """
+    ranges = []
+    start = 0
+    while start < len(data):
+        end = data.find(linesep, start + block_size)
+        end = len(data) if end == -1 else end + len(linesep)
+        ranges.append((len(ranges), start, end))
+        start = end
+    return ranges
+
+
+def parse_records_parallel(data: bytes, field_map: dict, tasks: int, show_progress: bool = False,
+                           block_size: int = 4 * 1024 * 1024) -> pd.DataFrame:
+    """ Parse the $TANAV records of the raw (decompressed) track in a pool of tasks processes """
+    import multiprocessing
+    from multiprocessing import shared_memory
+    block_size = max(1, min(block_size, math.ceil(len(data) / (tasks * RANGES_PER_TASK))))
+    ranges = byte_ranges(data, field_map['linesep'].encode('Latin-1'), block_size)
+    shared = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    try:
+        shared.buf[:len(data)] = data
+        with multiprocessing.Pool(processes=tasks, initializer=_init_worker,
+                                  initargs=(shared.name, field_map)) as pool:
+            results = pool.imap_unordered(_parse_byte_range, ranges)
+            if show_progress:
+                from tqdm import tqdm
+                results = tqdm(results, total=len(ranges), desc='Progress')
+            results = sorted(results, key=lambda result: result[0])
+    finally:
+        shared.close()
+        shared.unlink()
+    return assemble([result[2] for result in results], [result[1] for result in results])
@@ -0,0 +1,164 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Derived channels of a track, computed with numpy on whole columns.
+# A channel is registered with the columns it needs, which can be track columns or other derived channels.
+# DerivedChannels computes a channel only when it is asked for, after its inputs, and keeps the result,
+# so a chart and an export asking for the same channel of the same track pay once.
+# A per record channel (the default) only depends on the inputs of the same record, so when rows are appended
+# to a track it is computed on the new rows only (DerivedChannels.extended). Rolling means and the maneuvers
+# look at the neighbouring records and are computed again.
+
+Derived = namedtuple('Derived', ['name', 'inputs', 'func', 'dtype', 'per_record'])
+
+DERIVED = dict()
+ROLLING_WINDOW = '30s'
+
+
+def derived(name: str, inputs: tuple, dtype=np.float32, per_record: bool = True):
+    """ Register func(*input arrays) -> array (one value per record) as the derived channel name """
+    def register(func):
+        DERIVED[name] = Derived(name, tuple(inputs), func, dtype, per_record)
+        return func
+
+    return register
+
+
+def rolling_mean(times: np.ndarray, values: np.ndarray, window: str = ROLLING_WINDOW) -> np.ndarray:
+    """ Mean over the window of time before each record, records without a time get NaN """
+    result = np.full(len(values), np.nan)
+    valid = ~np.isnat(times)
+    order = np.flatnonzero(valid)[np.argsort(times[valid], kind='stable')]
+    series = pd.Series(values[order], index=pd.DatetimeIndex(times[order]))
+    result[order] = series.rolling(window, min_periods=1).mean().to_numpy()
+    return result
+
+
+def circular_rolling_mean(times: np.ndarray, degrees: np.ndarray, window: str = ROLLING_WINDOW) -> np.ndarray:
+    radians = np.radians(degrees)
+    sin, cos = rolling_mean(times, np.sin(radians), window), rolling_mean(times, np.cos(radians), window)
+    return np.degrees(np.arctan2(sin, cos)) % 360
+
+
+@derived('twa_c', ('twa',))
+def twa_c(twa):
+    """ TWA from -180 (port) to 180 (starboard) """
+    return np.where(twa < 180, twa, twa - 360)
+
+
+@derived('vmg_c', ('bsp', 'twa'))
+def vmg_c(bsp, twa):
+    return bsp * np.cos(np.radians(twa))
+
+
+def true_wind(awa, aws, bsp) -> tuple:
+    """ (TWA 0-360, TWS) from the apparent wind and the boat speed, no leeway nor current.
+    Not a channel itself, a channel is one array per record """
+    awa = np.radians(awa)
+    along = aws * np.cos(awa) - bsp
+    across = aws * np.sin(awa)
+    return np.degrees(np.arctan2(across, along)) % 360, np.hypot(along, across)
+
+
+@derived('true_twa', ('awa', 'aws', 'bsp'))
+def true_twa(awa, aws, bsp):
+    return true_wind(awa, aws, bsp)[0]
+
+
+@derived('true_tws', ('awa', 'aws', 'bsp'))
+def true_tws(awa, aws, bsp):
+    return true_wind(awa, aws, bsp)[1]
+
+
+@derived('true_twd', ('true_twa', 'heading_true'))
+def true_twd(twa, heading):
+    return (heading + twa) % 360
+
+
+@derived('maneuver', ('twa_c',), dtype=np.int8, per_record=False)
+def maneuver(twa):
+    """ 1 at a tack, 2 at a gybe (records where the wind changes side), else 0 """
+    side = pd.Series(np.sign(twa)).replace(0, np.nan).ffill().to_numpy()
+    changed = np.zeros(len(twa), dtype=bool)
+    changed[1:] = (side[1:] != side[:-1]) & ~np.isnan(side[:-1]) & ~np.isnan(side[1:])
+    downwind = np.abs(pd.Series(twa).ffill().to_numpy()) > 90
+    return np.where(changed, np.where(downwind, 2, 1), 0)
+
+
+@derived('polar_pct', ('bsp', 'polar_bsp'))
+def polar_pct(bsp, polar_bsp):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(polar_bsp > 0, 100 * bsp / polar_bsp, np.nan)
+
+
+@derived('bsp_avg', ('utc_datetime', 'bsp'), per_record=False)
+def bsp_avg(times, bsp):
+    return rolling_mean(times, bsp)
+
+
+@derived('tws_avg', ('utc_datetime', 'tws'), per_record=False)
+def tws_avg(times, tws):
+    return rolling_mean(times, tws)
+
+
+@derived('twd_avg', ('utc_datetime', 'twd'), per_record=False)
+def twd_avg(times, twd):
+    return circular_rolling_mean(times, twd)
+
+
+class DerivedChannels:
+    """ Derived channels of one track, each computed at most once """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.values = dict()
+
+    def available(self, name: str) -> bool:
+        if name in self.df.columns:
+            return True
+        channel = DERIVED.get(name)
+        return channel is not None and all(self.available(i) for i in channel.inputs)
+
+    def get(self, name: str, computing: tuple = ()):
+        if name in self.df.columns:
+            column = self.df[name]
+            if column.dtype.kind == 'M':
+                return column.to_numpy(dtype='datetime64[ns]')
+            return column.to_numpy(dtype=np.float64, na_value=np.nan)
+        if name in self.values:
+            return self.values[name]
+        if name in computing:
+            raise ValueError(f"Derived channels depend on each other: {' -> '.join(computing + (name,))}")
+        channel = DERIVED.get(name)
+        if channel is None:
+            raise KeyError(f"{name} is neither a track column nor a derived channel")
+        values = channel.func(*(self.get(i, computing + (name,)) for i in channel.inputs))
+        if channel.dtype is not None:
+            values = np.asarray(values).astype(channel.dtype)
+        self.values[name] = values
+        return values
+
+    def per_record(self, name: str) -> bool:
+        channel = DERIVED.get(name)
+        return channel is None or (channel.per_record and all(self.per_record(i) for i in channel.inputs))
+
+    def extended(self, df: pd.DataFrame) -> 'DerivedChannels':
+        """ Channels of df, this track with rows appended after its last one. The per record channels already
+        computed are computed on the new rows only and appended, the others are computed again when asked """
+        channels = DerivedChannels(df)
+        new_rows = DerivedChannels(df.iloc[len(self.df):])
+        for name, values in self.values.items():
+            if self.per_record(name):
+                channels.values[name] = np.concatenate([values, new_rows.get(name)])
+        return channels
+
+    def frame(self, columns: list) -> pd.DataFrame:
+        """ Track columns and derived channels, the ones the track can not give are left out """
+        data = dict()
+        for name in dict.fromkeys(columns):
+            if not self.available(name):
+                continue
+            data[name] = self.df[name] if name in self.df.columns else pd.Series(self.get(name), index=self.df.index)
+        return pd.DataFrame(data, index=self.df.index)
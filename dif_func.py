@@ -2,14 +2,23 @@ import datetime
 
 
 def benchmark(func):
+    import functools
     import time
+    from instrumentation import STATS
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         name = func.__name__
-        start = time.time()
-        return_value = func(*args, **kwargs)
-        end = time.time()
-        print(f'{name} Время выполнения: {end - start} секунд.')
+        start = time.perf_counter()
+        failed = True
+        try:
+            return_value = func(*args, **kwargs)
+            failed = False
+        finally:
+            # recorded and printed also when func raises
+            elapsed = time.perf_counter() - start
+            STATS.record(name, elapsed, failed)
+            print(f'{name} Время выполнения: {elapsed:.3f} секунд.')
         return return_value
 
     return wrapper
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+# Reduce a series to a point budget before it goes to the browser.
+# min_max keeps the lowest and the highest point of every bucket, so gusts and tack headings survive.
+# lttb (Largest-Triangle-Three-Buckets) keeps the visual shape with one point per bucket.
+
+
+def min_max(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """ Indexes of the points to keep, about n_out (first and last point included) """
+    n = len(y)
+    if n <= n_out or n_out < 4:
+        return np.arange(n)
+    buckets = n_out // 2
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    starts = edges[:-1]
+    # argmin/argmax per bucket: reduceat gives the extremes, the first matching position is the index
+    lows = np.minimum.reduceat(y, starts)
+    highs = np.maximum.reduceat(y, starts)
+    bucket_of = np.repeat(np.arange(buckets), np.diff(edges))
+    is_low = y == lows[bucket_of]
+    is_high = y == highs[bucket_of]
+    low_index = np.full(buckets, n, dtype=np.int64)
+    high_index = np.full(buckets, n, dtype=np.int64)
+    np.minimum.at(low_index, bucket_of[is_low], np.flatnonzero(is_low))
+    np.minimum.at(high_index, bucket_of[is_high], np.flatnonzero(is_high))
+    return np.unique(np.concatenate([low_index, high_index, [0, n - 1]]))
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """ Indexes of the points to keep, exactly n_out when the series is longer """
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+        # Twice the area of the triangle (previous point, candidate, average of the next bucket)
+        areas = np.abs((x[previous] - average_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (average_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+METHODS = {'min_max': min_max, 'lttb': lttb}
+
+
+def downsample_long(df: pd.DataFrame, x: str, columns: list, n_points: int, method: str = 'min_max') -> pd.DataFrame:
+    """ Long format (x, variable, value) of the columns, each series reduced to about n_points """
+    select = METHODS[method]
+    parts = []
+    for column in columns:
+        series = df[[x, column]].dropna()
+        x_values = series[x].to_numpy()
+        y_values = series[column].to_numpy(dtype=np.float64)
+        index = select(x_values.view(np.int64) if x_values.dtype.kind == 'M' else x_values, y_values, n_points)
+        parts.append(pd.DataFrame({x: x_values[index], 'variable': column, 'value': y_values[index]}))
+    if not parts:
+        return pd.DataFrame(columns=[x, 'variable', 'value'])
+    return pd.concat(parts, ignore_index=True)
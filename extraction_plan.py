@@ -0,0 +1,82 @@
+from collections import namedtuple
+from functools import lru_cache
+
+# Extraction plan of a $TANAV record layout, compiled once per VarXdr header and field map.
+# Each output column knows its cell indexes, the minimal record length it needs and the kind of
+# converter, so the parse backends only do index lookups per record.
+# The plan holds no functions, every backend maps the converter kind to its own implementation.
+#
+# StaticColumn.positions has two cells for lat/lon (value and hemisphere), which are always read.
+# XdrColumn.flag is the validity flag cell, 'N' or '' means no value.
+# An XDR channel with the name of a static field is only a fallback, used when a short record
+# has no cell for the static field.
+
+StaticColumn = namedtuple('StaticColumn', ['name', 'positions', 'min_length', 'kind'])
+XdrColumn = namedtuple('XdrColumn', ['name', 'position', 'flag', 'min_length', 'fallback', 'kind'])
+ExtractionPlan = namedtuple('ExtractionPlan', ['fingerprint', 'static_columns', 'xdr_columns'])
+
+
+def converter_kind(name: str, int_fields: tuple, converted_fields: tuple) -> str:
+    if name in converted_fields:
+        return name
+    if name in int_fields:
+        return 'int'
+    return 'float'
+
+
+@lru_cache(maxsize=64)
+def _compile(fingerprint: tuple) -> ExtractionPlan:
+    static_items, xdr_names, start_index_xdr_fields, int_fields, converted_fields = fingerprint
+    static_columns = []
+    for name, value in static_items:
+        if type(value) == tuple:
+            static_columns.append(StaticColumn(name, value, 0, converter_kind(name, int_fields, converted_fields)))
+        else:
+            static_columns.append(StaticColumn(name, (value,), value + 2, converter_kind(name, int_fields,
+                                                                                          converted_fields)))
+    static_names = set(name for name, _ in static_items)
+    xdr_columns = []
+    seen = set()
+    for index, name in enumerate(xdr_names):
+        if name == '' or name in seen:
+            # A later channel with the same name never wins, its cells are further in the record
+            continue
+        seen.add(name)
+        position = start_index_xdr_fields + index * 2
+        xdr_columns.append(XdrColumn(name, position, position + 1, position + 3, name in static_names,
+                                     converter_kind(name, int_fields, converted_fields)))
+    return ExtractionPlan(fingerprint, tuple(static_columns), tuple(xdr_columns))
+
+
+def compile_plan(static_fields_pos: dict, xdr_fields: list, start_index_xdr_fields: int, int_fields: tuple,
+                 converted_fields: tuple) -> ExtractionPlan:
+    """ Plan for the layout, shared by all tracks with the same instrument configuration """
+    fingerprint = (tuple(static_fields_pos.items()), tuple(field.short_name for field in xdr_fields),
+                   start_index_xdr_fields, tuple(int_fields), tuple(converted_fields))
+    return _compile(fingerprint)
+
+
+def row_layout(plan: ExtractionPlan, length: int) -> dict:
+    """ Output column -> plan column for a record of the given number of cells """
+    layout = dict()
+    for column in plan.static_columns:
+        if length >= column.min_length:
+            layout[column.name] = column
+    for column in plan.xdr_columns:
+        if length >= column.min_length and not (column.fallback and column.name in layout):
+            layout[column.name] = column
+    return layout
+
+
+def last_position(plan: ExtractionPlan) -> int:
+    """ Index of the last record cell the plan reads """
+    return max([position for column in plan.static_columns for position in column.positions]
+               + [column.flag for column in plan.xdr_columns] + [0])
+
+
+def project_plan(plan: ExtractionPlan, columns: tuple) -> ExtractionPlan:
+    """ Plan of only the given output columns, the other cells of the records are never converted """
+    names = set(columns)
+    return ExtractionPlan(plan.fingerprint + (tuple(columns),),
+                          tuple(column for column in plan.static_columns if column.name in names),
+                          tuple(column for column in plan.xdr_columns if column.name in names))
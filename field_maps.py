@@ -0,0 +1,84 @@
+import os
+from collections import namedtuple
+
+import toml
+
+# Registry of the $TANAV field maps of the Adrena versions.
+# Versions 17 and 20 are built in, more can be added without code edits in field_maps.toml next to this
+# module (or the file named by the ADRENA_FIELD_MAPS environment variable):
+#
+# [versions.21]
+# start_index_xdr_fields = 47
+# [versions.21.static_fields_pos]
+# utc_date = 1
+# utc_time = 1
+# lat = [3, 4]
+# ...
+
+FieldMap = namedtuple('FieldMap', ['version', 'static_fields_pos', 'start_index_xdr_fields'])
+
+FIELD_MAPS = dict()
+
+# Fields parsed as integers, whatever the version
+INT_FIELDS = ('cog', 'heading_true', 'twd', 'awa', 'twa', 'cur_dir', 'tide_percent', 'pos_quality', 'pos_integrity',
+              'sats_view', 'sdgps_status', 'gps_fix_type')
+
+_COMMON_FIELDS_POS = dict(utc_date=1, utc_time=1, lat=(3, 4), lon=(5, 6), sog=8, cog=10, bsp=12, heading_true=14,
+                          twd=16, awa=18, aws=20, twa=22, tws=24, depth=26, vmg=28, local_date=31, local_time=32,
+                          atm_pressure=38, air_temp=40, water_temp=42)
+
+
+def register_field_map(version: int, static_fields_pos: dict, start_index_xdr_fields: int = 47) -> FieldMap:
+    field_map = FieldMap(version, dict(static_fields_pos), start_index_xdr_fields)
+    FIELD_MAPS[version] = field_map
+    return field_map
+
+
+def load_field_maps(path: str):
+    config = toml.load(path)
+    for version, item in config.get('versions', dict()).items():
+        static_fields_pos = {key: tuple(value) if isinstance(value, list) else value
+                             for key, value in item['static_fields_pos'].items()}
+        register_field_map(int(version), static_fields_pos, item.get('start_index_xdr_fields', 47))
+
+
+def required_length(field_map: FieldMap) -> int:
+    """ Number of cells a record needs to hold all static fields of the map """
+    return max(max(value) + 1 if type(value) == tuple else value + 2
+               for value in field_map.static_fields_pos.values())
+
+
+def version_fields(field_map: FieldMap, field_maps: list) -> tuple:
+    """ Static fields of the map at a position not all the other maps have them at """
+    return tuple(name for name, position in field_map.static_fields_pos.items()
+                 if any(other.static_fields_pos.get(name) != position for other in field_maps if other is not field_map))
+
+
+def detect_field_map(records: list, evidence) -> FieldMap:
+    """
+    Field map for the sample records, among the maps the records are long enough for. Only the version specific
+    fields are evidence: evidence(field_map, records, names) -> (fields, failures) gives the number of the named
+    fields with a value that converts and the number of values that do not, an empty cell is no evidence.
+    The newest map is kept unless an older one is confirmed, all its version specific fields converting and none
+    failing, while the newest is not. Current and tide cells are empty when they are not computed, so the
+    newest map is never dropped for missing values.
+    """
+    longest = max((len(record.split(',')) for record in records), default=0)
+    candidates = sorted(FIELD_MAPS.values(), key=lambda field_map: field_map.version, reverse=True)
+    fitting = [field_map for field_map in candidates if required_length(field_map) <= longest]
+    if not fitting:
+        return candidates[0]
+    for field_map in fitting:
+        names = version_fields(field_map, fitting)
+        fields, failures = evidence(field_map, records, names)
+        if failures == 0 and fields == len(names):
+            return field_map
+    return fitting[0]
+
+
+register_field_map(17, dict(_COMMON_FIELDS_POS, cur_speed=229, cur_dir=230, tide_height=236, tide_percent=237))
+register_field_map(20, dict(_COMMON_FIELDS_POS, cur_speed=296, cur_dir=297, tide_height=303, tide_percent=304))
+
+_config_path = os.environ.get('ADRENA_FIELD_MAPS', os.path.join(os.path.dirname(__file__), 'field_maps.toml'))
+if os.path.exists(_config_path):
+    load_field_maps(_config_path)
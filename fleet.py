@@ -0,0 +1,132 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from ingest_service import IngestService, read_data_version
+from instrumentation import stage
+
+# Several boats (and the coach RIB) side by side. Every source is an FTP server with its own ingest service,
+# so its own download directory, track cache and live track, and all of them sync concurrently.
+# The sources come from the secrets: [data] is the main boat as before (its files stay in local_dir) and
+# every [sources.<name>] table is one more, with its files in local_dir/<name>:
+#   [sources.coach]
+#   FTP_HOST = "..."
+#   FTP_USER = "..."
+#   FTP_PASS = "..."
+#   LABEL = "Coach RIB"     # optional, as are REMOTE_DIR and PATTERN
+# aligned() puts the boats on one clock with merge_asof and keeps the result until a track gets new rows.
+# On a clock of a rollup resolution (10 s, 1 min, 10 min) the boats come from their rollup means, not raw rows.
+
+MAIN_SOURCE = 'new_europe'
+ALIGNED_CACHE_SIZE = 8
+
+
+def source_configs(secrets) -> dict:
+    """ name -> config of every source of the secrets, with the directory of its files under local_dir """
+    sources = dict()
+    if 'data' in secrets:
+        config = dict(secrets['data'])
+        sources[config.get('BOAT', MAIN_SOURCE)] = dict(config, SUBDIR='')
+    for name, config in secrets.get('sources', dict()).items():
+        sources[name] = dict(config, SUBDIR=name)
+    return sources
+
+
+def align_tracks(frames: dict, freq: str = '1s', start=None, end=None, tolerance=None) -> pd.DataFrame:
+    """ Tracks (utc_datetime and channels, ordered) of several boats on one clock of period freq.
+    Every tick takes the nearest record of each boat within tolerance (freq by default), a boat without a record
+    that close gets NaN. Index is the clock, columns are (boat, channel) """
+    frames = {name: df.dropna(subset=['utc_datetime']) for name, df in frames.items()}
+    frames = {name: df for name, df in frames.items() if len(df)}
+    if not frames:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='utc_datetime'))
+    start = pd.Timestamp(start) if start is not None else min(df['utc_datetime'].iloc[0] for df in frames.values())
+    end = pd.Timestamp(end) if end is not None else max(df['utc_datetime'].iloc[-1] for df in frames.values())
+    clock = pd.DataFrame({'utc_datetime': pd.date_range(start.ceil(freq), end.floor(freq), freq=freq)})
+    clock['utc_datetime'] = clock['utc_datetime'].astype('datetime64[ns]')
+    tolerance = pd.Timedelta(tolerance if tolerance is not None else freq)
+    parts = [pd.merge_asof(clock, df, on='utc_datetime', direction='nearest', tolerance=tolerance)
+             .set_index('utc_datetime') for df in frames.values()]
+    return pd.concat(parts, axis=1, keys=list(frames), names=['boat', 'channel'])
+
+
+class Fleet:
+
+    def __init__(self, services: dict, labels: dict | None = None):
+        self.services = services
+        self.labels = dict(labels or dict())
+        for name in services:
+            self.labels.setdefault(name, name)
+        self.lock = threading.Lock()
+        self.aligned_cache = OrderedDict()  # key -> (derived channels of the boats, aligned frame)
+
+    @classmethod
+    def from_secrets(cls, secrets, local_dir: str = "downloaded_files", interval: float = 30) -> 'Fleet':
+        services = dict()
+        labels = dict()
+        for name, config in source_configs(secrets).items():
+            services[name] = IngestService.from_config(
+                config['FTP_HOST'], config['FTP_USER'], config['FTP_PASS'], os.path.join(local_dir, config['SUBDIR']),
+                boat=name, interval=interval, remote_dir=config.get('REMOTE_DIR', ''),
+                pattern=config.get('PATTERN', '*.jtz'))
+            labels[name] = config.get('LABEL', name)
+        return cls(services, labels)
+
+    @property
+    def boats(self) -> list:
+        return list(self.services)
+
+    def start(self):
+        """ Start the ingest thread of every source """
+        for service in self.services.values():
+            service.start()
+
+    def run(self):
+        """ Standalone daemon: every source in its own thread, until they stop """
+        self.start()
+        for service in self.services.values():
+            service.thread.join()
+
+    def data_version(self) -> int:
+        # Each source only counts up, so the sum changes whenever one of them publishes
+        return sum(read_data_version(service.local_dir) for service in self.services.values())
+
+    def refresh(self) -> int:
+        """ Load the segments a standalone daemon added to any of the tracks """
+        return sum(service.live_track.refresh() for service in self.services.values())
+
+    def live_track(self, boat: str):
+        return self.services[boat].live_track
+
+    def track_frame(self, boat: str, channel_set, channels: list, freq: str, start=None, end=None) -> pd.DataFrame:
+        rollups = self.live_track(boat).rollups
+        if freq in rollups.resolutions:
+            stats = rollups.summary(freq, start, end, channels)
+            if set(channels) <= set(stats.columns.get_level_values('channel')):
+                return stats.xs('mean', axis=1, level='stat').reset_index()
+        return channel_set.frame(['utc_datetime'] + list(channels))
+
+    def aligned(self, channels: list, boats: list | None = None, freq: str = '1s', start=None,
+                end=None) -> pd.DataFrame:
+        """ align_tracks of the channels (track columns or derived channels) of the boats, computed again only
+        when one of the tracks has new rows. A boat with a rollup of freq holding all the channels gives its
+        bucket means """
+        boats = list(boats if boats is not None else self.services)
+        derived = tuple(self.live_track(boat).derived() for boat in boats)
+        key = (tuple(boats), tuple(channels), freq, start, end)
+        with self.lock:
+            cached = self.aligned_cache.get(key)
+            if cached is not None and all(a is b for a, b in zip(cached[0], derived)):
+                self.aligned_cache.move_to_end(key)
+                return cached[1]
+        with stage('align'):
+            aligned = align_tracks({boat: self.track_frame(boat, channel_set, channels, freq, start, end)
+                                    for boat, channel_set in zip(boats, derived)}, freq, start, end)
+        with self.lock:
+            self.aligned_cache[key] = (derived, aligned)
+            self.aligned_cache.move_to_end(key)
+            while len(self.aligned_cache) > ALIGNED_CACHE_SIZE:
+                self.aligned_cache.popitem(last=False)
+        return aligned
@@ -0,0 +1,218 @@
+import fnmatch
+import ftplib
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ftputil
+
+from instrumentation import count, stage
+
+# Sync engine for the boat FTP server.
+# Connections are kept in a small pool and reused between polls. Changes are found by comparing the
+# size and mtime of the remote listing with a local manifest of completed downloads. Files are
+# downloaded in parallel into .part files, an interrupted transfer is resumed from the size of its
+# .part file, and failures are retried with exponential backoff. The remote size and mtime a .part file was
+# started from are kept next to it (.part.json), a .part file of an older version of the remote file is dropped.
+# session_factory is passed to ftputil, so a local stand-in server (or any ftplib.FTP like class) can
+# be used for tests, e.g. ftputil.session.session_factory(port=2121).
+
+
+class FtpSync:
+
+    def __init__(self, host: str, user: str, password: str, local_dir: str, remote_dir: str = '',
+                 pattern: str = '*.jtz', connections: int = 3, session_factory=ftplib.FTP, retries: int = 4,
+                 backoff: float = 2.0):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.pattern = pattern
+        self.connections = connections
+        self.session_factory = session_factory
+        self.retries = retries
+        self.backoff = backoff
+        self.hosts = queue.LifoQueue()
+        self.hosts_opened = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.local_dir, exist_ok=True)
+        self.manifest_path = os.path.join(self.local_dir, '.sync_manifest.json')
+        self.manifest = dict()  # name -> [size, mtime] of the remote file when it was downloaded
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    # Connection pool *************************************************************************
+    def acquire(self) -> tuple:
+        """ (host, reused): a pooled connection when there is one, else a new one while under the limit """
+        try:
+            return self.hosts.get_nowait(), True
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.hosts_opened < self.connections
+            if can_open:
+                self.hosts_opened += 1
+        if not can_open:
+            return self.hosts.get(), True
+        try:
+            return ftputil.FTPHost(self.host, self.user, self.password, session_factory=self.session_factory), False
+        except Exception:
+            with self.lock:
+                self.hosts_opened -= 1
+            raise
+
+    def release(self, host: ftputil.FTPHost, broken: bool = False):
+        if broken:
+            with self.lock:
+                self.hosts_opened -= 1
+            try:
+                host.close()
+            except Exception:
+                pass
+        else:
+            self.hosts.put(host)
+
+    def with_host(self, func):
+        """ func(host) on a pooled connection, a connection that failed is dropped. A reused one may have been
+        closed by the server while idle, so func is tried again at once on the next connection. Only a failure
+        on a new connection is raised (and retried with backoff by the caller) """
+        while True:
+            host, reused = self.acquire()
+            try:
+                result = func(host)
+            except Exception:
+                self.release(host, broken=True)
+                if reused:
+                    continue
+                raise
+            self.release(host)
+            return result
+
+    def close(self):
+        while True:
+            try:
+                host = self.hosts.get_nowait()
+            except queue.Empty:
+                break
+            self.release(host, broken=True)
+
+    # Sync ************************************************************************************
+    def remote_path(self, name: str) -> str:
+        return f"{self.remote_dir.rstrip('/')}/{name}" if self.remote_dir else name
+
+    def remote_listing(self) -> dict:
+        def listing(host):
+            host.stat_cache.clear()
+            path = self.remote_dir or host.curdir
+            files = dict()
+            for name in host.listdir(path):
+                if fnmatch.fnmatch(name, self.pattern):
+                    stat = host.stat(self.remote_path(name))  # served from the cached directory listing
+                    files[name] = [stat.st_size, stat.st_mtime]
+            return files
+
+        return self.with_host(listing)
+
+    def changed_files(self, listing: dict) -> list:
+        names = []
+        for name, state in listing.items():
+            if name not in self.manifest:
+                # Downloaded before the manifest existed
+                target = os.path.join(self.local_dir, name)
+                if os.path.exists(target) and os.path.getsize(target) == state[0]:
+                    self.manifest[name] = state
+            if self.manifest.get(name) != state:
+                names.append(name)
+        return sorted(names)
+
+    def download(self, name: str, state: list) -> str:
+        """ Download the remote file of the listing state [size, mtime] """
+        target = os.path.join(self.local_dir, name)
+        part = target + '.part'
+        part_state = part + '.json'
+        size = state[0]
+        try:
+            with open(part_state) as f:
+                resumable = json.load(f) == list(state)
+        except (OSError, ValueError):
+            resumable = False
+        if not resumable:
+            # Joining it to the new version would corrupt the file, and the manifest would never fetch it again
+            if os.path.exists(part):
+                os.remove(part)
+            with open(part_state, 'w') as f:
+                json.dump(list(state), f)
+
+        def transfer(host):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset > size:
+                offset = 0
+            with host.open(self.remote_path(name), 'rb', rest=offset or None) as source, \
+                    open(part, 'ab' if offset else 'wb') as dest:
+                for block in iter(lambda: source.read(256 * 1024), b''):
+                    dest.write(block)
+
+        with stage('download'):
+            self.retry(lambda: self.with_host(transfer), f'download {name}')
+        os.replace(part, target)
+        os.remove(part_state)
+        count('files_downloaded')
+        count('bytes_downloaded', size)
+        return target
+
+    def retry(self, func, what: str):
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except (ftputil.error.FTPError, OSError, EOFError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print(f'{what} failed ({e}), retry in {delay:.0f} s')
+                time.sleep(delay)
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def sync(self) -> list:
+        """ Download the new and changed files, return their local paths in name order """
+        with stage('ftp_listing'):
+            listing = self.retry(self.remote_listing, 'listing')
+        names = self.changed_files(listing)
+        downloaded = []
+        if not names:
+            return downloaded
+        with ThreadPoolExecutor(self.connections) as exe:
+            futures = {name: exe.submit(self.download, name, listing[name]) for name in names}
+            for name in names:
+                try:
+                    downloaded.append(futures[name].result())
+                except Exception as e:
+                    print(f'download {name} failed: {e}')
+                    continue
+                self.manifest[name] = listing[name]
+        self.save_manifest()
+        return downloaded
+
+    def run_forever(self, interval: float = 30, on_new_files=None):
+        """ Sync every interval seconds, on_new_files(paths) gets the downloaded files """
+        failures = 0
+        while True:
+            try:
+                downloaded = self.sync()
+                failures = 0
+                if downloaded and on_new_files is not None:
+                    on_new_files(downloaded)
+            except Exception as e:
+                failures += 1
+                print(f'sync failed: {e}')
+                self.close()
+            time.sleep(min(interval * 2 ** failures, 600) if failures else interval)
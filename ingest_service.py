@@ -0,0 +1,102 @@
+import os
+import threading
+
+import toml
+
+from instrumentation import profiled, stage
+from live_track import LiveTrack
+from track_cache import TrackCache
+
+# One ingest worker per source (boat): FTP sync, parse and cache, for every viewer of the app.
+# It runs in a background thread of the Streamlit process (one per process and source, see main.fleet)
+# or as a standalone daemon for all the sources: python ingest_service.py [secrets.toml]
+# Every time new rows reach the live track the data version in local_dir/.data_version goes up,
+# so the UI only has to read a small file to know that it should redraw.
+# ftputil (ftp_sync) is imported when a service is built, reading what a daemon published does not need it.
+
+TRACK_EXTENSIONS = (".jtz", ".trz", ".trc")
+
+
+def list_track_files(local_dir: str) -> list:
+    # Only the track files, not the cache, the sync manifest or partial downloads
+    return [f for f in os.listdir(local_dir) if os.path.isfile(os.path.join(local_dir, f))
+            and f.endswith(TRACK_EXTENSIONS)]
+
+
+def read_data_version(local_dir: str) -> int:
+    try:
+        with open(os.path.join(local_dir, '.data_version')) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+class IngestService:
+
+    def __init__(self, sync: 'FtpSync', live_track: LiveTrack, local_dir: str, interval: float = 30):
+        self.sync = sync
+        self.live_track = live_track
+        self.local_dir = local_dir
+        self.interval = interval
+        self.version_path = os.path.join(local_dir, '.data_version')
+        self.version = read_data_version(local_dir)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, ftp_host: str, ftp_user: str, ftp_pass: str, local_dir: str = "downloaded_files",
+                    boat: str = "new_europe", interval: float = 30, remote_dir: str = '',
+                    pattern: str = '*.jtz') -> 'IngestService':
+        from ftp_sync import FtpSync
+        track_cache = TrackCache(os.path.join(local_dir, ".cache"))
+        live_track = LiveTrack(boat, os.path.join(local_dir, ".live"), track_cache)
+        return cls(FtpSync(ftp_host, ftp_user, ftp_pass, local_dir, remote_dir, pattern), live_track, local_dir,
+                   interval)
+
+    def publish(self):
+        self.version += 1
+        tmp_path = self.version_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(self.version))
+        os.replace(tmp_path, self.version_path)
+
+    def ingest(self, paths: list):
+        rows = 0
+        for path in paths:
+            try:
+                with profiled('ingest'), stage('ingest'):
+                    rows += self.live_track.ingest(path)
+            except Exception as e:
+                print(f"{path} is not correct, skipped: {e}")
+        if rows:
+            self.publish()
+
+    def catch_up(self):
+        """ Ingest the local files the live track has not seen, e.g. downloaded before a restart """
+        files = sorted(list_track_files(self.local_dir))
+        self.ingest([os.path.join(self.local_dir, f) for f in files
+                     if not self.live_track.is_ingested(os.path.join(self.local_dir, f))])
+
+    def run(self):
+        self.catch_up()
+        self.sync.run_forever(self.interval, self.ingest)
+
+    def start(self):
+        """ Start the worker thread, once """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='ingest', daemon=True)
+            self.thread.start()
+
+
+def main():
+    import sys
+    from fleet import Fleet
+    # Every source of the secrets, see fleet.py
+    secrets_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join('.streamlit', 'secrets.toml')
+    Fleet.from_secrets(toml.load(secrets_path)).run()
+
+
+if __name__ == '__main__':
+    main()
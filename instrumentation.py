@@ -0,0 +1,102 @@
+import cProfile
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Stage timings and counters of the whole process: download, gunzip, split, convert, DataFrame build,
+# cache, downsample and chart render.
+#   with stage('gunzip', bytes=len(data)): ...    or    @timed('chart')
+#   count('rows', len(df))
+# A stage is recorded also when it raises. snapshot() gives the totals, the app shows them in its sidebar.
+# With ADRENA_PROFILE=directory, profiled(name) blocks also write a cProfile dump there (name-time.prof).
+
+PROFILE_DIR = os.environ.get('ADRENA_PROFILE')
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = dict()  # name -> [calls, errors, total_s, max_s, last_s]
+        self.counters = dict()
+
+    def record(self, name: str, seconds: float, failed: bool = False):
+        with self.lock:
+            item = self.stages.setdefault(name, [0, 0, 0.0, 0.0, 0.0])
+            item[0] += 1
+            item[1] += failed
+            item[2] += seconds
+            item[3] = max(item[3], seconds)
+            item[4] = seconds
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stages = {name: dict(calls=calls, errors=errors, total_s=total, mean_s=total / calls, max_s=longest,
+                                 last_s=last)
+                      for name, (calls, errors, total, longest, last) in self.stages.items()}
+            return dict(stages=stages, counters=dict(self.counters))
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+
+
+STATS = Stats()
+
+
+def count(name: str, value: float = 1):
+    STATS.count(name, value)
+
+
+@contextmanager
+def stage(name: str, **counters):
+    """ Time the block as stage name and add the counters (e.g. bytes=..., rows=...) """
+    start = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        STATS.record(name, time.perf_counter() - start, failed)
+        for key, value in counters.items():
+            STATS.count(key, value)
+
+
+def timed(name: str | None = None):
+    """ Decorator version of stage, the function name is the stage name by default """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profiled(name: str):
+    """ cProfile the block when ADRENA_PROFILE is set, otherwise do nothing """
+    if not PROFILE_DIR:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.prof"))
+
+
+def snapshot() -> dict:
+    return STATS.snapshot()
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from pyarrow import feather
+
+from derived import DerivedChannels
+from rollups import Rollups
+from track_cache import TrackCache
+from track_schema import SCHEMA_VERSION, concat_tracks
+
+# Time-indexed track of one boat that grows file by file, the race timeline of all its files.
+# Every ingested file is parsed once, the rows with utc_datetime already in the track are dropped
+# and the rest is written as a new segment, so an update costs as much as the new data only.
+# The whole track frame of the app is kept and the new segments are appended to it (sorted again only when
+# they overlap the times it has), with the per record derived channels computed on the new rows only.
+# The new rows also go into the rollup tables (rollups.py) that long windows are charted from.
+
+
+class LiveTrack:
+
+    def __init__(self, boat: str, directory: str = os.path.join("downloaded_files", ".live"),
+                 cache: TrackCache | None = None):
+        self.boat = boat
+        self.directory = os.path.join(directory, boat)
+        self.cache = cache if cache is not None else TrackCache()
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = dict(schema=SCHEMA_VERSION, files=dict(), segments=[])
+        self.manifest_mtime = None
+        if os.path.exists(self.manifest_path):
+            self.manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            # Segments of another schema are left behind, the files are ingested again
+            if manifest.get('schema') == SCHEMA_VERSION:
+                self.manifest = manifest
+        self.segments = [feather.read_table(os.path.join(self.directory, name), memory_map=True).to_pandas()
+                         for name in self.manifest['segments']]
+        self.times = np.sort(np.concatenate([self.segment_times(df) for df in self.segments] + [np.array([], 'i8')]))
+        self.rollups = Rollups(self.directory)
+        if self.segments and not self.rollups.load():
+            # Tracks ingested before the rollups existed, or of another rollup layout
+            self.rollups.rebuild(self.segments)
+            self.rollups.save()
+        self.df = None
+        self.pending = []  # segments not in df yet
+        self.channels = None
+
+    @staticmethod
+    def segment_times(df: pd.DataFrame) -> np.ndarray:
+        return df['utc_datetime'].to_numpy(dtype='datetime64[ns]').view('i8')
+
+    def is_ingested(self, file_name: str) -> bool:
+        # A file that grew since it was ingested (downloaded again) is ingested again, known rows are dropped
+        known = self.manifest['files'].get(os.path.basename(file_name))
+        return known is not None and known[1] == os.path.getsize(file_name)
+
+    def ingest(self, file_name: str) -> int:
+        """ Add the rows of a new file, return the number of new rows """
+        name = os.path.basename(file_name)
+        size = os.path.getsize(file_name)
+        if self.is_ingested(file_name):
+            return 0
+        df = self.cache.parse(file_name)
+        df = df[df['utc_datetime'].notna()].drop_duplicates('utc_datetime', keep='last')
+        with self.lock:
+            new_times = self.segment_times(df)
+            index = np.searchsorted(self.times, new_times).clip(max=len(self.times) - 1)
+            known = (self.times[index] == new_times) if len(self.times) else np.zeros(len(df), dtype=bool)
+            df = df[~known].reset_index(drop=True)
+            if len(df):
+                segment_name = f"segment_s{SCHEMA_VERSION}_{len(self.manifest['segments']):05d}.feather"
+                feather.write_feather(df, os.path.join(self.directory, segment_name), compression='uncompressed')
+                self.manifest['segments'].append(segment_name)
+                self.segments.append(df)
+                self.pending.append(df)
+                self.times = np.union1d(self.times, new_times[~known])
+                self.rollups.update(df)
+                self.rollups.save()
+            self.manifest['files'][name] = [len(df), size]
+            self.save_manifest()
+        return len(df)
+
+    def refresh(self) -> int:
+        """ Load the segments another process (the ingest daemon) added since, return their number """
+        if not os.path.exists(self.manifest_path):
+            return 0
+        # Called on every rerun of the app, the manifest is read only when it changed
+        mtime = os.stat(self.manifest_path).st_mtime_ns
+        if mtime == self.manifest_mtime:
+            return 0
+        self.manifest_mtime = mtime
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('schema') != SCHEMA_VERSION:
+            return 0
+        with self.lock:
+            new_names = manifest['segments'][len(self.manifest['segments']):]
+            if not new_names:
+                return 0
+            new_segments = [feather.read_table(os.path.join(self.directory, name), memory_map=True).to_pandas()
+                            for name in new_names]
+            self.segments.extend(new_segments)
+            self.pending.extend(new_segments)
+            self.times = np.union1d(self.times, np.concatenate([self.segment_times(df) for df in new_segments]))
+            # The daemon writes the rollups before the manifest
+            if not self.rollups.load():
+                self.rollups.rebuild(self.segments)
+            self.manifest = manifest
+        return len(new_names)
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def data(self) -> pd.DataFrame:
+        """ Whole track ordered by utc_datetime """
+        with self.lock:
+            if self.df is None:
+                if not self.segments:
+                    return pd.DataFrame(columns=['utc_datetime'])
+                df = concat_tracks(self.segments)
+                if not df['utc_datetime'].is_monotonic_increasing:
+                    df = df.sort_values('utc_datetime', ignore_index=True)
+                self.df = df
+            elif self.pending:
+                self.append(self.pending)
+            self.pending = []
+            return self.df
+
+    def append(self, segments: list):
+        """ Add new segments to df, in the common case they are after its last row and df is not sorted again """
+        new = concat_tracks(segments) if len(segments) > 1 else segments[0]
+        times = new['utc_datetime']
+        in_order = times.is_monotonic_increasing and \
+            (len(self.df) == 0 or times.iloc[0] > self.df['utc_datetime'].iloc[-1])
+        df = concat_tracks([self.df, new])
+        if in_order:
+            if self.channels is not None and self.channels.df is self.df:
+                self.channels = self.channels.extended(df)
+        else:
+            df = df.sort_values('utc_datetime', ignore_index=True)
+        self.df = df
+
+    def rows_between(self, start=None, end=None) -> slice:
+        """ Rows of data() from start to end (UTC, both included), found by bisection of the ordered times """
+        times = self.data()['utc_datetime'].to_numpy(dtype='datetime64[ns]')
+        first = 0 if start is None else int(np.searchsorted(times, np.datetime64(pd.Timestamp(start), 'ns'), 'left'))
+        last = len(times) if end is None else \
+            int(np.searchsorted(times, np.datetime64(pd.Timestamp(end), 'ns'), 'right'))
+        return slice(first, last)
+
+    def derived(self) -> DerivedChannels:
+        """ Derived channels of the current track, kept until new rows arrive """
+        df = self.data()
+        with self.lock:
+            if self.channels is None or self.channels.df is not df:
+                self.channels = DerivedChannels(df)
+            return self.channels
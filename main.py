@@ -1,90 +1,69 @@
-import threading
+import datetime
 
+import pandas as pd
 import streamlit as st
-import altair as alt
-import ftputil
 import os
-import time
-
-from adrena import AdrenaTrack
-
-ftp_host = st.secrets['data']['FTP_HOST']
-ftp_user = st.secrets['data']['FTP_USER']
-ftp_pass = st.secrets['data']['FTP_PASS']
-
-
-# Function to connect to the FTP server and download files
-def download_files():
-    while True:
-        try:
-            local_dir = "downloaded_files"
-            with ftputil.FTPHost(ftp_host, ftp_user, ftp_pass) as host:
-                remote_dir = "/your/remote/directory"
-
-                # host.chdir(remote_dir)
-                list_dir = host.listdir(host.curdir)
-                downloaded_files_list = [f for f in os.listdir(local_dir) if os.path.isfile(os.path.join(local_dir, f))]
-
-                is_file_downloaded = False
-                for name in list_dir:
-                    if name.endswith(".jtz") and (not (name in downloaded_files_list)):
-                        if host.download(name, os.path.join(local_dir, name)):
-                            st.write(f"Downloaded {name}")
-                            is_file_downloaded = True
-
-        except Exception as e:
-            st.error(f"Error: {str(e)}")
-        finally:
-            if is_file_downloaded:
-                st.rerun()
-        time.sleep(30)
-
-
-def calculate_twa(row):
-    if row['twa'] < 180:
-        return row['twa']
-    else:
-        return row['twa'] - 360
-
-
-def draw_chart(df_or, var_list):
-    df = df_or.copy()
-    df['utc_datetime'] = df['utc_datetime'].dt.tz_localize('UTC')
-
-    chart = alt.Chart(df.melt(id_vars='utc_datetime', var_name='variable', value_name='value')).mark_line().encode(
-        x=alt.X('utc_datetime:T', axis=alt.Axis(format='%Y-%m-%d %H:%M:%S', title='Your local Time')),
-        y=alt.Y('value:Q', title='Value'),
-        color='variable:N',
-        tooltip=['utc_datetime:T', 'value:Q', 'variable:N']
-    ).transform_filter(
-        alt.FieldOneOfPredicate(field='variable', oneOf=var_list)
-    ).properties(
-        # title=f'Chart for {" ".join(var_list)}',
-        width=600,
-        height=400
-    )
-
-    # Manually set y-axis domain based on the minimum and maximum values of both variables
-    y_min = df[var_list].min().min()
-    y_max = df[var_list].max().max()
-    chart = chart.encode(alt.Y(f'value:Q', scale=alt.Scale(domain=(y_min, y_max))))
-    # Move the legend to the bottom
-    chart = chart.configure_legend(orient='bottom')
-    # Display the chart in Streamlit
-    st.altair_chart(chart, use_container_width=True)
-
-
-def pars_draw(file_name):
-    track = AdrenaTrack(file_name)
-    df = track.trz_parsing(tasks=0, show_progress=False)
-    df['twa_c'] = df.apply(calculate_twa, axis=1)
-    draw_chart(df, ["heading_true", "cog"])
-    draw_chart(df, ["bsp", "sog"])
-    draw_chart(df, ["tws"])
-    draw_chart(df, ["twa_c"])
-    draw_chart(df, ["twd"])
-    draw_chart(df, ["cur_speed"])
-    draw_chart(df, ["cur_dir"])
+
+from fleet import Fleet
+from ingest_service import list_track_files
+from instrumentation import profiled, snapshot, stage
+
+LOCAL_DIR = "downloaded_files"
+REFRESH_SECONDS = 5
+CHART_WIDTH = 600
+
+
+# One fleet (an ingest service per boat, see fleet.py) per server process, shared by every session and
+# every rerun. With INGEST_DAEMON = true in the secrets the services run apart (python ingest_service.py)
+# and the app only reads what they publish.
+@st.cache_resource
+def fleet() -> Fleet:
+    boats = Fleet.from_secrets(st.secrets, LOCAL_DIR)
+    if not st.secrets.get('data', dict()).get('INGEST_DAEMON', st.secrets.get('INGEST_DAEMON', False)):
+        boats.start()
+    return boats
+
+
+def wait_for_new_data(seen_version: int):
+    """ Rerun the app when an ingest service publishes a new data version. The check is a fragment rerun on a
+    timer, the script itself finishes and widgets stay responsive """
+    @st.fragment(run_every=REFRESH_SECONDS)
+    def watch():
+        if fleet().data_version() != seen_version:
+            st.rerun()
+
+    watch()
+
+
+CHART_PANELS = [["heading_true", "cog"], ["bsp", "sog"], ["tws"], ["twa_c"], ["twd"], ["cur_speed"], ["cur_dir"]]
+COMPARE_CHANNELS = ["bsp", "tws", "twa_c", "twd", "heading_true", "vmg_c", "polar_pct"]
+ALIGN_CLOCKS = {"1 s": "1s", "10 s": "10s", "1 min": "1min"}
+
+
+def chart_frame(live_track, start, end) -> pd.DataFrame:
+    """ utc_datetime and the chart columns over start-end, from the coarsest rollup with a bucket per pixel,
+    from the raw rows when the window is too short for any """
+    columns = [column for var_list in CHART_PANELS for column in var_list]
+    freq = live_track.rollups.pick(start, end, CHART_WIDTH)
+    if freq is not None:
+        with stage('rollup'):
+            df = live_track.rollups.envelope(freq, columns, start, end)
+        if len(df):
+            return df
+    # Derived channels such as twa_c are computed once per track version and shared by all sessions
+    with stage('derive'):
+        return live_track.derived().frame(['utc_datetime'] + columns).iloc[live_track.rows_between(start, end)]
+
+
+def pars_draw(df: pd.DataFrame):
+    # altair is loaded with the first chart, not for the downloads page
+    from charts import prepare_long, track_chart
+    columns = [column for var_list in CHART_PANELS for column in var_list]
+    # One long format copy of the data for all panels
+    with stage('downsample', points=len(df) * len(columns)):
+        long_df = prepare_long(df, columns, CHART_WIDTH)
+    with stage('chart'):
+        st.altair_chart(track_chart(long_df, CHART_PANELS, CHART_WIDTH))
 
     # st.line_chart(df, x='utc_datetime', y='tws')
     # st.line_chart(df, x='utc_datetime', y='twd')
@@ -93,60 +72,110 @@ def pars_draw(file_name):
     # st.line_chart(df, x='utc_datetime', y='heading_true')
 
 
+def compare_draw(boats: Fleet, names: list, columns: list, freq: str, start, end):
+    from charts import comparison_chart, prepare_comparison
+    # The aligned boats are kept by the fleet until a track gets new rows, a rerun only draws again
+    aligned = boats.aligned(columns, names, freq, start, end)
+    with stage('downsample', points=aligned.size):
+        long_df = prepare_comparison(aligned, columns, boats.labels)
+    with stage('chart'):
+        st.altair_chart(comparison_chart(long_df, columns))
+
+
+def time_window(first, last):
+    """ Slider over first-last (UTC), (None, None) when there is nothing to choose """
+    if not first < last:
+        return None, None
+    return st.slider("Time window (UTC)", min_value=first, max_value=last, value=(first, last),
+                     step=datetime.timedelta(minutes=1), format="DD/MM HH:mm")
+
+
+def show_stats():
+    # Stage timings of this server process, the ingest thread included (not a standalone ingest daemon)
+    stats = snapshot()
+    with st.sidebar.expander("Performance"):
+        if stats['stages']:
+            st.dataframe(pd.DataFrame.from_dict(stats['stages'], orient='index').sort_values('total_s', ascending=False)
+                         .style.format(precision=3))
+        st.dataframe(pd.Series(stats['counters'], name='value', dtype='float64'))
+
+
 def main():
     st.title("IMOCA New Europe live DATA")
 
-    option = st.selectbox("Select a page:", ["Recent data Graphs", "All Adrena Files"])
-    local_dir = "downloaded_files"
+    boats = fleet()
+    pages = ["Recent data Graphs"] + (["Fleet comparison"] if len(boats.boats) > 1 else []) + ["All Adrena Files"]
+    option = st.selectbox("Select a page:", pages)
+    os.makedirs(LOCAL_DIR, exist_ok=True)
 
     if option == "Recent data Graphs":
         st.header("Graphs Page")
 
-        # Create a directory for downloaded files
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-
         st.write("Data will updates every 30 minutes...")
 
-        # Process and display the downloaded data
-        all_files = os.listdir(local_dir)
-        # files = [file for file in all_files if file.endswith("jtz")]
-        files = all_files
-        files.sort(reverse=True)
-        file_path = os.path.join(local_dir, files[0])
-
-        try:
-            st.write(f"Processing {file_path}...")
-            pars_draw(file_path)
-
-        except Exception:
-            try:
-                file_path = os.path.join(local_dir, files[1])
-                st.write(f"Processing {file_path}...")
-                pars_draw(file_path)
-            except Exception:
-                st.write("Latest data is not correct, please wait for next update")
+        seen_version = boats.data_version()
+        # Segments written by a standalone ingest daemon, nothing to do when the services run here
+        boats.refresh()
+        boat = boats.boats[0]
+        if len(boats.boats) > 1:
+            boat = st.selectbox("Boat", boats.boats, format_func=boats.labels.get)
+        live_track = boats.live_track(boat)
+        df = live_track.data()
+        if df.empty:
+            st.write("Latest data is not correct, please wait for next update")
+        else:
+            # The whole race from all files, the window picks the part to draw
+            first, last = df['utc_datetime'].iloc[0].to_pydatetime(), df['utc_datetime'].iloc[-1].to_pydatetime()
+            start, end = time_window(first, last)
+            pars_draw(chart_frame(live_track, start or first, end or last))
+        # The page waits for new data once it is drawn and the stats are shown
+        return seen_version
+
+    elif option == "Fleet comparison":
+        st.header("Fleet comparison")
+
+        seen_version = boats.data_version()
+        boats.refresh()
+        names = st.multiselect("Boats", boats.boats, default=boats.boats, format_func=boats.labels.get)
+        columns = st.multiselect("Channels", COMPARE_CHANNELS, default=COMPARE_CHANNELS[:4])
+        clock = st.radio("Common clock", list(ALIGN_CLOCKS), horizontal=True)
+        times = [boats.live_track(name).data()['utc_datetime'] for name in names]
+        times = [series for series in times if len(series)]
+        if not (names and columns and times):
+            st.write("Choose boats with data and channels")
+        else:
+            start, end = time_window(min(series.iloc[0] for series in times).to_pydatetime(),
+                                     max(series.iloc[-1] for series in times).to_pydatetime())
+            compare_draw(boats, names, columns, ALIGN_CLOCKS[clock], start, end)
+        return seen_version
 
     elif option == "All Adrena Files":
         st.header("Download Links Page")
 
-        # Display download links for the files
-        st.write("Download the following files:")
-        files = os.listdir(local_dir)
+        boat = boats.boats[0]
+        if len(boats.boats) > 1:
+            boat = st.selectbox("Boat", boats.boats, format_func=boats.labels.get)
+        local_dir = boats.services[boat].local_dir
+        # Only the chosen file is read, and only after the click
+        files = list_track_files(local_dir)
         files.sort(reverse=True)
-        for file in files:
-            # download_link = f'<a href="{local_dir}/{file}" download="{file}">Download {file}</a>'
-            # st.markdown(download_link, unsafe_allow_html=True)
-            file_path = os.path.join(local_dir, file)
-            with open(file_path, 'rb') as f:
-                st.download_button(file, f, file_name=file_path)
+        if not files:
+            st.write("No files yet")
+            return None
+        file = st.selectbox("File", files, format_func=lambda f: (
+            f"{f} ({os.path.getsize(os.path.join(local_dir, f)) / 1e6:.1f} MB)"))
+        if st.button("Prepare download"):
+            st.session_state['prepared_file'] = (boat, file)
+        if st.session_state.get('prepared_file') == (boat, file):
+            with open(os.path.join(local_dir, file), 'rb') as f:
+                st.download_button(f"Download {file}", f, file_name=file,
+                                   on_click=lambda: st.session_state.pop('prepared_file', None))
+    return None
 
 
 if __name__ == '__main__':
-    # Create a separate thread for downloading files
-    download_thread = threading.Thread(target=download_files)
-    download_thread.daemon = True
-    download_thread.start()
-
-    # Run the Streamlit app
-    main()
+    with profiled('page'), stage('page'):
+        seen_version = main()
+    show_stats()
+    if seen_version is not None:
+        wait_for_new_data(seen_version)
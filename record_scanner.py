@@ -0,0 +1,126 @@
+import gzip
+import mmap
+import os
+
+import numpy as np
+
+# Byte level index of the records of a track, without decoding or copying it as a whole.
+# The buffer is a memory mapped .trc file or the decompressed bytes of a .trz/.jtz/.trx. The scanner finds the
+# line separators with numpy, chunk by chunk, and keeps the (start, end) offsets of the $TANAV and VarXdr
+# records. Only the records asked for are decoded, from memoryview slices of the buffer, and the scan stops as
+# soon as it has what was asked: the header and the first records of a large track cost one chunk.
+#   scanner = RecordScanner(map_file('track.trc'))
+#   scanner.first(b'VarXdr'), scanner.lines(b'$TANAV', limit=20), scanner.records(b'$TANAV')
+
+RECORD_TYPES = (b'$TANAV', b'VarXdr')
+ENCODING = 'Latin-1'
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def map_file(path: str):
+    """ Read only memory map of the file, an empty file (which can not be mapped) gives b'' """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_gzip(path: str) -> bytes:
+    """ Whole decompressed .trz/.jtz file """
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+class RecordScanner:
+
+    def __init__(self, buffer, linesep: bytes = b'\n', chunk_size: int = CHUNK_SIZE):
+        if len(linesep) != 1:
+            raise ValueError(f"Line separator must be one byte, not {linesep!r}")
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.linesep = linesep
+        self.chunk_size = chunk_size
+        self.scanned = 0  # bytes of the buffer already indexed, always at a line start
+        self.offsets = {record_type: [] for record_type in RECORD_TYPES}  # type -> [(starts, ends) per chunk]
+        self.found = dict.fromkeys(RECORD_TYPES, 0)
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def chunk_end(self, begin: int) -> int:
+        """ End of the chunk from begin, just after the first line separator past chunk_size bytes """
+        end = min(begin + self.chunk_size, len(self.view))
+        while end < len(self.view):
+            window = np.frombuffer(self.view[end:end + 65536], dtype=np.uint8)
+            separators = np.flatnonzero(window == self.linesep[0])
+            if len(separators):
+                return end + int(separators[0]) + 1
+            end += len(window)
+        return end
+
+    def scan_chunk(self):
+        """ Index the records of the next chunk of whole lines """
+        begin, end = self.scanned, self.chunk_end(self.scanned)
+        data = np.frombuffer(self.view[begin:end], dtype=np.uint8)
+        separators = np.flatnonzero(data == self.linesep[0])
+        starts = np.concatenate(([0], separators + 1))
+        ends = np.concatenate((separators, [len(data)]))
+        if len(starts) and starts[-1] == len(data):
+            starts, ends = starts[:-1], ends[:-1]
+        for record_type in RECORD_TYPES:
+            # A record starts with its type and a comma
+            width = len(record_type) + 1
+            selected = np.flatnonzero(ends - starts >= width)
+            for position, byte in enumerate(record_type + b','):
+                selected = selected[data[starts[selected] + position] == byte]
+            if len(selected):
+                self.offsets[record_type].append((starts[selected] + begin, ends[selected] + begin))
+                self.found[record_type] += len(selected)
+        self.scanned = end
+
+    def scan(self, record_type: bytes | None = None, limit: int | None = None):
+        """ Index until limit records of record_type are known, or the whole buffer """
+        while self.scanned < len(self.view) and (limit is None or self.found[record_type] < limit):
+            self.scan_chunk()
+
+    def index(self, record_type: bytes = b'$TANAV', limit: int | None = None) -> tuple:
+        """ (starts, ends) byte offsets of the records, the first limit ones or all of them """
+        self.scan(record_type, limit)
+        chunks = self.offsets[record_type]
+        if not chunks:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        if len(chunks) > 1:
+            chunks[:] = [(np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks]))]
+        starts, ends = chunks[0]
+        return starts[:limit], ends[:limit]
+
+    def records(self, record_type: bytes = b'$TANAV', limit: int | None = None) -> list:
+        """ memoryview slices of the records, nothing is copied """
+        starts, ends = self.index(record_type, limit)
+        return [self.view[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def lines(self, record_type: bytes = b'$TANAV', limit: int | None = None) -> list:
+        """ Records decoded one by one, the rest of the buffer is never decoded """
+        starts, ends = self.index(record_type, limit)
+        view = self.view
+        return [str(view[start:end], ENCODING) for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def first(self, record_type: bytes = b'VarXdr') -> str | None:
+        lines = self.lines(record_type, limit=1)
+        return lines[0] if lines else None
+
+    def iter_lines(self):
+        """ All the lines, decoded a chunk at a time """
+        separator = self.linesep.decode(ENCODING)
+        begin = 0
+        while begin < len(self.view):
+            end = self.chunk_end(begin)
+            text = str(self.view[begin:end], ENCODING)
+            yield from text[:-1].split(separator) if text.endswith(separator) else text.split(separator)
+            begin = end
+
+    def close(self):
+        self.offsets = {record_type: [] for record_type in RECORD_TYPES}
+        self.view.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
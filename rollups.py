@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pyarrow import feather
+
+from derived import DerivedChannels
+from instrumentation import stage
+from track_schema import SCHEMA_VERSION
+
+# Rollup tables of a track at 10 s, 1 min and 10 min, so a long window is charted or queried from a few
+# thousand buckets instead of the raw 1 Hz rows.
+# A table holds per bucket and channel the stats that merge: number of values, sum (sin and cos sums for
+# angles), min and max. New rows only touch their own buckets, so the tables are updated file by file, and
+# summary() turns them into mean (circular mean for angles), min and max.
+#   freq = rollups.pick(start, end, width=600)    the coarsest table with a bucket per pixel, None for raw rows
+#   rollups.envelope(freq, ['bsp', 'twd'], start, end), rollups.summary(freq, start, end)
+
+RESOLUTIONS = ('10s', '1min', '10min')  # finest first
+# Angles in degrees, averaged on the circle. Signed ones are from -180 to 180, the others from 0 to 360
+ANGULAR_CHANNELS = ('twd', 'cog', 'heading_true', 'awa', 'twa', 'cur_dir', 'twa_c', 'true_twa', 'true_twd')
+SIGNED_ANGLES = ('twa_c',)
+# Derived channels of one record only, they can be rolled up segment by segment
+ROLLUP_DERIVED = ('twa_c', 'vmg_c', 'polar_pct')
+SKIPPED = ('utc_datetime', 'local_offset')
+
+MERGE = dict(n='sum', sum='sum', sin='sum', cos='sum', min='min', max='max')
+
+
+def rollup_channels(df: pd.DataFrame) -> list:
+    return [name for name in df.columns if name not in SKIPPED and df[name].dtype.kind in 'fiu'
+            and not isinstance(df[name].dtype, pd.CategoricalDtype)] + \
+        [name for name in ROLLUP_DERIVED if name not in df.columns and DerivedChannels(df).available(name)]
+
+
+def aggregate(df: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """ Stats of the rows per bucket of freq, columns 'channel:stat', index the bucket start """
+    rows = df[df['utc_datetime'].notna()]
+    channels = DerivedChannels(rows)
+    bucket = rows['utc_datetime'].dt.floor(freq).to_numpy()
+    sums, mins, maxs = dict(), dict(), dict()
+    for name in rollup_channels(rows):
+        values = channels.get(name).astype(np.float64)
+        sums[f'{name}:n'] = ~np.isnan(values)
+        if name in ANGULAR_CHANNELS:
+            radians = np.radians(values)
+            sums[f'{name}:sin'], sums[f'{name}:cos'] = np.sin(radians), np.cos(radians)
+        else:
+            sums[f'{name}:sum'] = values
+        mins[f'{name}:min'] = values
+        maxs[f'{name}:max'] = values
+    if not sums:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='utc_datetime'))
+    table = pd.concat([pd.DataFrame(sums).groupby(bucket).sum(), pd.DataFrame(mins).groupby(bucket).min(),
+                       pd.DataFrame(maxs).groupby(bucket).max()], axis=1)
+    table.index.name = 'utc_datetime'
+    return table
+
+
+def merge(table: pd.DataFrame, partial: pd.DataFrame) -> pd.DataFrame:
+    """ Tables of the same freq as one, only the buckets both have are merged """
+    if table.empty:
+        return partial
+    touched = table.index.intersection(partial.index)
+    both = pd.concat([table.loc[touched], partial.loc[touched]])
+    merged = both.groupby(level=0).agg({column: MERGE[column.rsplit(':', 1)[1]] for column in both.columns})
+    result = pd.concat([table.drop(touched), merged, partial.drop(touched)]).sort_index()
+    result.index.name = 'utc_datetime'
+    return result
+
+
+def summary(table: pd.DataFrame, columns: list | None = None) -> pd.DataFrame:
+    """ Mean, min and max of the channels per bucket, columns (channel, stat) """
+    known = list(dict.fromkeys(column.rsplit(':', 1)[0] for column in table.columns))
+    data = dict()
+    for name in (known if columns is None else [column for column in columns if column in known]):
+        n = table[f'{name}:n'].fillna(0).to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if f'{name}:sin' in table.columns:
+                mean = np.degrees(np.arctan2(table[f'{name}:sin'].to_numpy(), table[f'{name}:cos'].to_numpy()))
+                mean = mean if name in SIGNED_ANGLES else mean % 360
+            else:
+                mean = table[f'{name}:sum'].to_numpy() / n
+        data[(name, 'mean')] = np.where(n > 0, mean, np.nan)
+        data[(name, 'min')] = table[f'{name}:min'].to_numpy()
+        data[(name, 'max')] = table[f'{name}:max'].to_numpy()
+    if not data:
+        return pd.DataFrame(index=table.index, columns=pd.MultiIndex.from_tuples([], names=['channel', 'stat']))
+    return pd.DataFrame(data, index=table.index, columns=pd.MultiIndex.from_tuples(data, names=['channel', 'stat']))
+
+
+class Rollups:
+    """ Rollup tables of one live track, kept in its directory next to the segments """
+
+    def __init__(self, directory: str, resolutions: tuple = RESOLUTIONS):
+        self.directory = directory
+        self.resolutions = resolutions
+        self.tables = {freq: pd.DataFrame() for freq in resolutions}
+
+    def path(self, freq: str) -> str:
+        return os.path.join(self.directory, f'rollup_s{SCHEMA_VERSION}_{freq}.feather')
+
+    def load(self) -> bool:
+        """ Tables written before (by this or another process), False when one is missing """
+        if not all(os.path.exists(self.path(freq)) for freq in self.resolutions):
+            return False
+        self.tables = {freq: feather.read_feather(self.path(freq)).set_index('utc_datetime')
+                       for freq in self.resolutions}
+        return True
+
+    def save(self):
+        for freq, table in self.tables.items():
+            tmp_path = self.path(freq) + '.tmp'
+            feather.write_feather(table.reset_index(), tmp_path, compression='uncompressed')
+            os.replace(tmp_path, self.path(freq))
+
+    def update(self, df: pd.DataFrame):
+        """ Add new rows (not already rolled up) to every table """
+        if len(df) == 0:
+            return
+        with stage('rollup_update', rows_rolled_up=len(df)):
+            for freq in self.resolutions:
+                self.tables[freq] = merge(self.tables[freq], aggregate(df, freq))
+
+    def rebuild(self, frames: list):
+        self.tables = {freq: pd.DataFrame() for freq in self.resolutions}
+        for df in frames:
+            self.update(df)
+
+    def pick(self, start, end, width: int) -> str | None:
+        """ Coarsest resolution with at least one bucket per pixel over start-end, None when only the raw rows
+        are fine enough """
+        span = pd.Timestamp(end) - pd.Timestamp(start)
+        fine_enough = [freq for freq in self.resolutions if pd.Timedelta(freq) * width <= span]
+        return fine_enough[-1] if fine_enough else None
+
+    def table(self, freq: str, start=None, end=None) -> pd.DataFrame:
+        table = self.tables[freq]
+        if table.empty:
+            return table
+        # The bucket start may be before start, its rows overlap the window
+        return table.loc[pd.Timestamp(start).floor(freq) if start is not None else None:
+                         pd.Timestamp(end) if end is not None else None]
+
+    def summary(self, freq: str, start=None, end=None, columns: list | None = None) -> pd.DataFrame:
+        return summary(self.table(freq, start, end), columns)
+
+    def envelope(self, freq: str, columns: list, start=None, end=None) -> pd.DataFrame:
+        """ utc_datetime and the columns, two rows per bucket: the min at its start and the max at its middle
+        (the circular mean twice for angles), the same shape the min_max downsampling keeps of raw rows """
+        stats = self.summary(freq, start, end, columns)
+        times = stats.index.to_numpy(dtype='datetime64[ns]')
+        data = dict(utc_datetime=np.column_stack([times, times + pd.Timedelta(freq).to_timedelta64() // 2]).ravel())
+        for name in stats.columns.get_level_values('channel').unique():
+            if name in ANGULAR_CHANNELS:
+                data[name] = np.repeat(stats[(name, 'mean')].to_numpy(), 2)
+            else:
+                data[name] = np.column_stack([stats[(name, 'min')].to_numpy(), stats[(name, 'max')].to_numpy()]).ravel()
+        return pd.DataFrame(data)
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from derived import DERIVED, DerivedChannels
+
+# Every registered channel is one value per record, so DerivedChannels.frame and batch_convert --derived can
+# offer all of them.
+
+
+def track(rows: int = 120) -> pd.DataFrame:
+    rnd = np.random.default_rng(0)
+    return pd.DataFrame(dict(
+        utc_datetime=pd.date_range('2023-07-22 10:00', periods=rows, freq='1s'),
+        awa=rnd.uniform(0, 360, rows), aws=rnd.uniform(5, 25, rows), bsp=rnd.uniform(4, 12, rows),
+        twa=rnd.uniform(0, 360, rows), tws=rnd.uniform(5, 25, rows), twd=rnd.uniform(0, 360, rows),
+        heading_true=rnd.uniform(0, 360, rows), polar_bsp=rnd.uniform(5, 12, rows)))
+
+
+def test_every_channel_is_a_column():
+    df = track()
+    frame = DerivedChannels(df).frame(list(DERIVED))
+    assert list(frame.columns) == list(DERIVED)
+    assert len(frame) == len(df)
+
+
+def test_true_wind():
+    # Head to wind at 6 kt with 16 kt apparent: 10 kt true from ahead
+    df = pd.DataFrame(dict(awa=[0.0, 90.0], aws=[16.0, 10.0], bsp=[6.0, 0.0], heading_true=[10.0, 200.0]))
+    frame = DerivedChannels(df).frame(['true_twa', 'true_tws', 'true_twd'])
+    np.testing.assert_allclose(frame['true_tws'], [10, 10], rtol=1e-6)
+    np.testing.assert_allclose(frame['true_twa'], [0, 90], atol=1e-4)
+    np.testing.assert_allclose(frame['true_twd'], [10, 290], atol=1e-4)
@@ -0,0 +1,42 @@
+import pytest
+
+from adrena import AdrenaTrack
+from bench_parsing import write_synthetic_track
+from field_maps import FIELD_MAPS
+
+# Version detection on synthetic tracks. Current and tide cells are empty when the log does not compute them,
+# empty cells must not make an older map win.
+
+
+def blank_fields(path: str, names: tuple, version: int = 20):
+    positions = [FIELD_MAPS[version].static_fields_pos[name] for name in names]
+    with open(path, encoding='Latin-1') as f:
+        lines = f.read().split('\n')
+    for index, line in enumerate(lines):
+        cells = line.split(',')
+        if cells[0] == '$TANAV':
+            for position in positions:
+                cells[position] = ''
+            lines[index] = ','.join(cells)
+    with open(path, 'w', encoding='Latin-1') as f:
+        f.write('\n'.join(lines))
+
+
+@pytest.mark.parametrize('version, xdr_channels', [(20, 100), (17, 100), (17, 150)])
+def test_detected_version(tmp_path, version, xdr_channels):
+    path = write_synthetic_track(str(tmp_path / 'track.trc'), version, duration_s=60, xdr_channels=xdr_channels)
+    assert AdrenaTrack(path, verbose=False).field_map_version == version
+
+
+def test_v20_without_current_and_tide(tmp_path):
+    path = write_synthetic_track(str(tmp_path / 'track.trc'), 20, duration_s=60)
+    blank_fields(path, ('cur_speed', 'cur_dir', 'tide_height', 'tide_percent'))
+    track = AdrenaTrack(path, verbose=False)
+    assert track.field_map_version == 20
+    df = track.columnar_parsing()
+    assert df[['cur_speed', 'cur_dir', 'tide_height', 'tide_percent']].isna().all().all()
+
+
+def test_requested_version(tmp_path):
+    path = write_synthetic_track(str(tmp_path / 'track.trc'), 20, duration_s=60)
+    assert AdrenaTrack(path, verbose=False, version=17).field_map_version == 17
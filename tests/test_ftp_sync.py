@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+
+import ftputil.session
+import pytest
+
+pyftpdlib = pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer  # noqa: E402
+from pyftpdlib.handlers import FTPHandler  # noqa: E402
+from pyftpdlib.servers import ThreadedFTPServer  # noqa: E402
+
+from ftp_sync import FtpSync  # noqa: E402
+
+# FtpSync against a local pyftpdlib server: first sync, resync, changed files, .part resume, and connections
+# the server dropped (idle timeout or restart), which must be replaced at once and not waited for with backoff.
+
+IDLE_TIMEOUT = 1
+
+
+class LocalServer:
+
+    def __init__(self, root: str, port: int = 0):
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('boat', 'secret', root, perm='elr')
+        handler = type('Handler', (FTPHandler,), dict(authorizer=authorizer, timeout=IDLE_TIMEOUT))
+        self.server = ThreadedFTPServer(('127.0.0.1', port), handler)
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs=dict(timeout=0.05), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.close_all()
+        self.thread.join(5)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    root = tmp_path / 'remote'
+    root.mkdir()
+    server = LocalServer(str(root))
+    yield root, server
+    server.stop()
+
+
+def make_sync(tmp_path, server) -> FtpSync:
+    return FtpSync('127.0.0.1', 'boat', 'secret', str(tmp_path / 'local'), connections=2,
+                   session_factory=ftputil.session.session_factory(port=server.port), retries=2, backoff=2.0)
+
+
+def local_files(sync: FtpSync) -> dict:
+    return {name: open(os.path.join(sync.local_dir, name), 'rb').read() for name in os.listdir(sync.local_dir)
+            if name.endswith('.jtz')}
+
+
+def write_part(sync: FtpSync, name: str, data: bytes, state: list | None):
+    part = os.path.join(sync.local_dir, name + '.part')
+    with open(part, 'wb') as f:
+        f.write(data)
+    if state is not None:
+        with open(part + '.json', 'w') as f:
+            json.dump(state, f)
+
+
+def test_sync_and_resync(tmp_path, remote):
+    root, server = remote
+    (root / 'a.jtz').write_bytes(b'a' * 1000)
+    (root / 'b.jtz').write_bytes(b'b' * 300000)
+    (root / 'notes.txt').write_bytes(b'not synced')
+    sync = make_sync(tmp_path, server)
+    assert [os.path.basename(path) for path in sync.sync()] == ['a.jtz', 'b.jtz']
+    assert local_files(sync) == {'a.jtz': b'a' * 1000, 'b.jtz': b'b' * 300000}
+    assert sync.sync() == []
+
+    (root / 'b.jtz').write_bytes(b'c' * 400000)
+    assert [os.path.basename(path) for path in sync.sync()] == ['b.jtz']
+    assert local_files(sync)['b.jtz'] == b'c' * 400000
+    # A new instance starts from the saved manifest
+    sync.close()
+    assert make_sync(tmp_path, server).sync() == []
+
+
+def test_part_file_is_resumed(tmp_path, remote):
+    root, server = remote
+    content = bytes(range(256)) * 1000
+    (root / 'a.jtz').write_bytes(content)
+    sync = make_sync(tmp_path, server)
+    # Different bytes than the server has, so a resumed transfer is told from a new one
+    write_part(sync, 'a.jtz', b'x' * 1000, sync.remote_listing()['a.jtz'])
+    sync.sync()
+    assert local_files(sync)['a.jtz'] == b'x' * 1000 + content[1000:]
+    assert not os.path.exists(os.path.join(sync.local_dir, 'a.jtz.part'))
+    assert not os.path.exists(os.path.join(sync.local_dir, 'a.jtz.part.json'))
+
+
+@pytest.mark.parametrize('part_state', [[1000, 0.0], None])
+def test_part_file_of_another_version_is_dropped(tmp_path, remote, part_state):
+    # The transfer was interrupted, then the remote file was rewritten (or the state of the .part is unknown)
+    root, server = remote
+    content = bytes(range(256)) * 1000
+    (root / 'a.jtz').write_bytes(content)
+    sync = make_sync(tmp_path, server)
+    write_part(sync, 'a.jtz', b'x' * 1000, part_state)
+    sync.sync()
+    assert local_files(sync)['a.jtz'] == content
+    assert sync.sync() == []
+
+
+def test_idle_connections_are_replaced_at_once(tmp_path, remote):
+    root, server = remote
+    (root / 'a.jtz').write_bytes(b'a' * 1000)
+    sync = make_sync(tmp_path, server)
+    sync.sync()
+    time.sleep(IDLE_TIMEOUT + 0.5)  # the server closes the pooled connections
+    (root / 'b.jtz').write_bytes(b'b' * 1000)
+    begin = time.perf_counter()
+    assert [os.path.basename(path) for path in sync.sync()] == ['b.jtz']
+    assert time.perf_counter() - begin < sync.backoff
+
+
+def test_server_restart(tmp_path, remote):
+    root, server = remote
+    (root / 'a.jtz').write_bytes(b'a' * 1000)
+    sync = make_sync(tmp_path, server)
+    sync.sync()
+    server.stop()
+    restarted = LocalServer(str(root), server.port)
+    try:
+        (root / 'b.jtz').write_bytes(b'b' * 1000)
+        begin = time.perf_counter()
+        assert [os.path.basename(path) for path in sync.sync()] == ['b.jtz']
+        assert time.perf_counter() - begin < sync.backoff
+    finally:
+        restarted.stop()
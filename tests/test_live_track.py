@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bench_parsing import write_synthetic_track
+from derived import DerivedChannels
+from live_track import LiveTrack
+from track_cache import TrackCache
+
+# A live track fed file by file: the frame is extended with the new rows, the per record derived channels too,
+# and it is the same track as one built from all the files at once.
+
+
+@pytest.fixture
+def files(tmp_path) -> list:
+    """ A synthetic track split in three files of consecutive records """
+    full = write_synthetic_track(str(tmp_path / 'full.trc'), 20, duration_s=600, xdr_channels=20)
+    with open(full, encoding='Latin-1') as f:
+        lines = f.read().splitlines()
+    header, records = lines[0], lines[1:]
+    paths = []
+    for index in range(3):
+        path = tmp_path / f'part{index}.trc'
+        path.write_text('\n'.join([header] + records[index * 200:(index + 1) * 200]) + '\n', encoding='Latin-1')
+        paths.append(str(path))
+    return paths
+
+
+def live_track(tmp_path, name: str) -> LiveTrack:
+    return LiveTrack('boat', str(tmp_path / name), TrackCache(str(tmp_path / 'cache')))
+
+
+def test_appended_files(tmp_path, files):
+    live = live_track(tmp_path, 'live')
+    live.ingest(files[0])
+    live.derived().get('twa_c')
+    live.derived().get('bsp_avg')
+    for path in files[1:]:
+        live.ingest(path)
+        channels = live.derived()
+        # Extended with the new rows, not computed again on the whole track
+        assert 'twa_c' in channels.values and 'bsp_avg' not in channels.values
+        channels.get('bsp_avg')
+
+    reference = live_track(tmp_path, 'reference')
+    for path in files:
+        reference.ingest(path)
+    pd.testing.assert_frame_equal(live.data(), reference.data())
+    assert len(live.data()) == 600
+    expected = DerivedChannels(reference.data())
+    for name in ('twa_c', 'bsp_avg'):
+        np.testing.assert_array_equal(live.derived().get(name), expected.get(name))
+
+
+def test_files_out_of_order(tmp_path, files):
+    live = live_track(tmp_path, 'live')
+    for path in (files[2], files[0], files[1]):
+        live.ingest(path)
+        live.derived().get('twa_c')
+    assert live.data()['utc_datetime'].is_monotonic_increasing
+    reference = live_track(tmp_path, 'reference')
+    for path in files:
+        reference.ingest(path)
+    pd.testing.assert_frame_equal(live.data(), reference.data())
+    np.testing.assert_array_equal(live.derived().get('twa_c'), DerivedChannels(reference.data()).get('twa_c'))
+
+
+def test_reload(tmp_path, files):
+    live = live_track(tmp_path, 'live')
+    for path in files:
+        live.ingest(path)
+    pd.testing.assert_frame_equal(live_track(tmp_path, 'live').data(), live.data())
@@ -0,0 +1,17 @@
+import pandas as pd
+import pytest
+
+from adrena import AdrenaTrack
+from bench_parsing import write_synthetic_track
+
+# The parse engines on synthetic tracks: the columnar, row by row and parallel paths give the same frame.
+
+
+@pytest.mark.parametrize('version', [17, 20])
+def test_engines_agree(tmp_path, version):
+    path = write_synthetic_track(str(tmp_path / 'track.trz'), version, duration_s=300, xdr_channels=30)
+    track = AdrenaTrack(path, verbose=False)
+    columnar = track.columnar_parsing()
+    assert len(columnar) == 300
+    pd.testing.assert_frame_equal(track.trz_parsing(0, show_progress=False), columnar)
+    pd.testing.assert_frame_equal(track.trz_parsing(2, show_progress=False), columnar)
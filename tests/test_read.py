@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from adrena import AdrenaTrack
+from bench_parsing import write_synthetic_track
+from track_blocks import write_track_blocks
+
+# AdrenaTrack.read on synthetic tracks: the window (both bounds included) and the projection are the same for
+# every format, an indexed track inflates only the blocks of the window.
+
+COLUMNS = ['bsp', 'lat', 'twd', 'X003', 'utc_time']
+
+
+@pytest.fixture(scope='module')
+def tracks(tmp_path_factory) -> dict:
+    """ format -> path of the same 10 min v20 track """
+    directory = tmp_path_factory.mktemp('tracks')
+    trc = write_synthetic_track(str(directory / 'track.trc'), 20, duration_s=600, xdr_channels=30)
+    trz = write_synthetic_track(str(directory / 'track.trz'), 20, duration_s=600, xdr_channels=30)
+    with open(trc, encoding='Latin-1') as f:
+        trx = write_track_blocks(f.read().splitlines(), str(directory / 'track.trx'), block_seconds=60)
+    return dict(trc=trc, trz=trz, trx=trx)
+
+
+@pytest.mark.parametrize('file_format', ['trc', 'trz', 'trx'])
+def test_read_window(tracks, file_format):
+    track = AdrenaTrack(tracks[file_format], verbose=False)
+    full = track.read(COLUMNS)
+    assert list(full.columns) == COLUMNS + ['utc_datetime']
+    pd.testing.assert_frame_equal(full, AdrenaTrack(tracks['trc'], verbose=False).read(COLUMNS))
+    start, end = full['utc_datetime'].iloc[100], full['utc_datetime'].iloc[250]
+    window = track.read(COLUMNS, start, end)
+    # Both bounds included
+    pd.testing.assert_frame_equal(window, full.iloc[100:251].reset_index(drop=True))
+    assert len(track.read(COLUMNS, start, start)) == 1
+
+
+@pytest.mark.parametrize('file_format', ['trc', 'trz', 'trx'])
+def test_read_empty_window(tracks, file_format):
+    track = AdrenaTrack(tracks[file_format], verbose=False)
+    empty = track.read(COLUMNS, '2000-01-01', '2000-01-02')
+    assert len(empty) == 0
+    assert dict(empty.dtypes) == dict(track.read(COLUMNS).dtypes)
+    assert track.read(start='2000-01-01', end='2000-01-02').shape[1] == track.columnar_parsing().shape[1]
+
+
+def test_read_unknown_column(tracks):
+    with pytest.raises(KeyError):
+        AdrenaTrack(tracks['trc'], verbose=False).read(['bsp', 'no_such_channel'])
+
+
+def test_trx_reads_only_the_window_blocks(tracks, monkeypatch):
+    track = AdrenaTrack(tracks['trx'], verbose=False)
+    assert len(track.blocks.blocks) == 10
+    read = []
+    original = track.blocks.read_blocks
+    monkeypatch.setattr(track.blocks, 'read_blocks', lambda blocks: read.extend(blocks) or original(blocks))
+    full = AdrenaTrack(tracks['trc'], verbose=False).read(COLUMNS)
+    window = track.read(COLUMNS, full['utc_datetime'].iloc[130], full['utc_datetime'].iloc[170])
+    assert len(window) == 41
+    assert len(read) == 1
+    np.testing.assert_array_equal(window['bsp'], full['bsp'].iloc[130:171])
@@ -0,0 +1,63 @@
+import zipfile
+
+import pytest
+
+import zipping_files
+from zipping_files import ParallelZip, raw_members_supported
+
+# ParallelZip writes members through zipfile and lzma internals, an archive of every method is read back with
+# zipfile, so a Python where those internals changed fails here.
+
+METHODS = ('deflate', 'bzip2', 'lzma')
+
+
+@pytest.fixture
+def files(tmp_path):
+    contents = {'empty.trc': b'',
+                'small.trc': b'$TANAV,12:00:00,1.5\n' * 10,
+                'large.trc': b''.join(b'$TANAV,%d,%d\n' % (i, i * 7 % 1013) for i in range(30000))}
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+    return contents
+
+
+def read_archive(zip_path: str) -> dict:
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.testzip() is None
+        for info in archive.infolist():
+            assert info.file_size == len(archive.read(info))
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def test_internals_available():
+    assert raw_members_supported()
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_round_trip(tmp_path, files, method):
+    zip_path = str(tmp_path / 'tracks.zip')
+    with ParallelZip(zip_path, method, jobs=2, chunk_size=64 * 1024, max_pending=2) as archive:
+        for name in files:
+            archive.add(str(tmp_path / name))
+    assert read_archive(zip_path) == files
+    # bzip2 and lzma members are compressed into temporary files, none is left
+    assert not list(tmp_path.glob('*.zpart'))
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_file_growing_while_archived(tmp_path, files, method, monkeypatch):
+    # The log is appended to between the stat of the file and its read
+    class GrowingZipInfo(zipfile.ZipInfo):
+        @classmethod
+        def from_file(cls, filename, arcname=None, **kwargs):
+            zinfo = super().from_file(filename, arcname, **kwargs)
+            with open(filename, 'ab') as f:
+                f.write(b'$TANAV,late record\n')
+            return zinfo
+
+    monkeypatch.setattr(zipping_files, 'ZipInfo', GrowingZipInfo)
+    zip_path = str(tmp_path / 'tracks.zip')
+    with ParallelZip(zip_path, method, jobs=2, chunk_size=64 * 1024) as archive:
+        for name in files:
+            archive.add(str(tmp_path / name))
+    assert read_archive(zip_path) == {name: data + b'$TANAV,late record\n' for name, data in files.items()}
@@ -0,0 +1,82 @@
+from datetime import date, datetime, time
+from functools import lru_cache
+
+import numpy as np
+
+# Fast decoding of the Adrena dates and times.
+# A one second log repeats the same date for a whole day, so dates go through dateutil once and are
+# kept in a bounded cache. 'HH:MM:SS' times are decoded arithmetically, strptime is only the fallback.
+# pandas and dateutil are imported on first use, the parsing core loads without them.
+
+HMS_FORMAT = "%H:%M:%S"
+NAT = np.datetime64('NaT', 'ns').astype(np.int64)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+@lru_cache(maxsize=4096)
+def _parse_day(text: str) -> date | None:
+    from dateutil import parser
+    try:
+        return parser.parse(text, dayfirst=True).date()
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_day(text: str) -> date:
+    """ Day first date, as dateutil.parser.parse(text, dayfirst=True).date() """
+    day = _parse_day(text)
+    if day is None:
+        raise ValueError(f"Unknown date format: {text}")
+    return day
+
+
+def hms_seconds(text: str, time_format: str = HMS_FORMAT) -> int:
+    """ Seconds since midnight """
+    if (time_format == HMS_FORMAT and len(text) == 8 and text[2] == ':' and text[5] == ':'
+            and text.isascii() and text[0:2].isdigit() and text[3:5].isdigit() and text[6:8].isdigit()):
+        hours, minutes, seconds = int(text[0:2]), int(text[3:5]), int(text[6:8])
+        if hours < 24 and minutes < 60 and seconds < 60:
+            return hours * 3600 + minutes * 60 + seconds
+    parsed = datetime.strptime(text, time_format)
+    return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+
+
+def parse_time(text: str, time_format: str = HMS_FORMAT) -> time:
+    seconds = hms_seconds(text, time_format)
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def utc_nanoseconds(text: str, time_format: str = HMS_FORMAT) -> int | None:
+    """ 'dd/mm/yyyy HH:MM:SS' field of a record as nanoseconds since the epoch, None when it does not parse """
+    day = _parse_day(text[0:text.find(' ')])
+    if day is None:
+        return None
+    try:
+        seconds = hms_seconds(text[text.find(' ') + 1:], time_format)
+    except ValueError:
+        return None
+    return ((day.toordinal() - EPOCH_ORDINAL) * 86400 + seconds) * 10 ** 9
+
+
+def to_nanoseconds(value) -> int | None:
+    """ Time bound given as anything pd.Timestamp takes (aware times are converted to UTC) """
+    if value is None:
+        return None
+    import pandas as pd
+    stamp = pd.Timestamp(value)
+    if stamp.tzinfo is not None:
+        stamp = stamp.tz_convert('UTC').tz_localize(None)
+    return stamp.value
+
+
+def to_datetime64(dates: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """ datetime64[ns] from date and time objects (None or NaN gives NaT), each converted once per unique value """
+    import pandas as pd
+    date_codes, date_uniques = pd.factorize(dates)
+    days = np.array([np.datetime64(d, 'ns').astype(np.int64) for d in date_uniques] + [NAT], dtype=np.int64)
+    time_codes, time_uniques = pd.factorize(times)
+    nanoseconds = np.array([((t.hour * 60 + t.minute) * 60 + t.second) * 10 ** 9 + t.microsecond * 1000
+                            for t in time_uniques] + [0], dtype=np.int64)
+    result = days[date_codes] + nanoseconds[time_codes]
+    result[(date_codes == -1) | (time_codes == -1)] = NAT
+    return result.view('datetime64[ns]')
@@ -0,0 +1,139 @@
+import json
+import os
+import struct
+import zlib
+
+from timestamps import HMS_FORMAT, to_nanoseconds, utc_nanoseconds
+
+# Indexed track container (.trx), for reading a time window without decompressing the whole track.
+# The lines of the track are cut in time blocks (block_seconds of records each) and every block is
+# deflated on its own. A JSON footer holds the VarXdr header line and, for every block, its byte range,
+# the first and last record time and the number of records:
+#   MAGIC, block 0, block 1, ..., index JSON, <index length: uint64 LE>, MAGIC
+# A window query reads the footer and inflates only the blocks that overlap the window.
+
+MAGIC = b'ADRTRX1\n'
+EXTENSION = '.trx'
+FORMAT_VERSION = 1
+TAIL = struct.Struct('<Q8s')
+
+
+class TrackBlockWriter:
+
+    def __init__(self, path: str, block_seconds: int = 300, level: int = 6, max_block_bytes: int = 8 * 1024 ** 2,
+                 linesep: str = '\n', time_format: str = HMS_FORMAT):
+        self.path = path
+        self.block_ns = block_seconds * 10 ** 9
+        self.level = level
+        self.max_block_bytes = max_block_bytes
+        self.linesep = linesep
+        self.time_format = time_format
+        self.index = dict(format=FORMAT_VERSION, linesep=linesep, header=None, blocks=[])
+        self.lines = []
+        self.size = 0
+        self.bucket = None
+        self.start = None
+        self.end = None
+        self.records = 0
+        self.file = open(path + '.tmp', 'wb')
+        self.file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path + '.tmp')
+
+    def write_line(self, line: str):
+        record_type = line[0:line.find(',')]
+        if record_type == '$TANAV':
+            fields = line.split(',', 2)
+            time_ns = utc_nanoseconds(fields[1], self.time_format) if len(fields) > 1 else None
+            if time_ns is not None:
+                bucket = time_ns // self.block_ns
+                if self.records and (bucket != self.bucket or self.size >= self.max_block_bytes):
+                    self.flush()
+                self.bucket = bucket
+                self.start = time_ns if self.start is None else min(self.start, time_ns)
+                self.end = time_ns if self.end is None else max(self.end, time_ns)
+            self.records += 1
+        elif record_type == 'VarXdr' and self.index['header'] is None:
+            self.index['header'] = line
+        self.lines.append(line)
+        self.size += len(line) + 1
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = zlib.compress((self.linesep.join(self.lines) + self.linesep).encode('Latin-1'), self.level)
+        self.index['blocks'].append([self.file.tell(), len(data), self.start, self.end, self.records])
+        self.file.write(data)
+        self.lines = []
+        self.size = 0
+        self.start = self.end = None
+        self.records = 0
+
+    def close(self):
+        self.flush()
+        index = json.dumps(self.index).encode('utf-8')
+        self.file.write(index)
+        self.file.write(TAIL.pack(len(index), MAGIC))
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+
+def write_track_blocks(lines, path: str, block_seconds: int = 300, level: int = 6) -> str:
+    """ Write the lines of a track as an indexed container, return its path """
+    with TrackBlockWriter(path, block_seconds, level) as writer:
+        for line in lines:
+            writer.write_line(line)
+    return path
+
+
+class TrackBlocks:
+    """ Reader of an indexed container """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            f.seek(-TAIL.size, os.SEEK_END)
+            index_size, magic = TAIL.unpack(f.read(TAIL.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an indexed track")
+            f.seek(-TAIL.size - index_size, os.SEEK_END)
+            self.index = json.loads(f.read(index_size))
+        self.header = self.index['header']
+        self.linesep = self.index['linesep']
+        self.blocks = self.index['blocks']
+
+    def select(self, start=None, end=None) -> list:
+        """ Blocks that may hold records between start and end, both included """
+        start, end = to_nanoseconds(start), to_nanoseconds(end)
+        # A block without any valid record time is always read, its records can not be placed
+        return [block for block in self.blocks
+                if block[2] is None or ((start is None or block[3] >= start) and (end is None or block[2] <= end))]
+
+    def read_blocks(self, blocks: list) -> bytes:
+        parts = []
+        with open(self.path, 'rb') as f:
+            for offset, length, *_ in blocks:
+                f.seek(offset)
+                parts.append(zlib.decompress(f.read(length)))
+        return b''.join(parts)
+
+    def read_bytes(self, start=None, end=None) -> bytes:
+        return self.read_blocks(self.select(start, end))
+
+    def iter_blocks(self, start=None, end=None):
+        """ Decompressed bytes of the blocks overlapping the window, one block in memory at a time """
+        for block in self.select(start, end):
+            yield self.read_blocks([block])
+
+    def iter_lines(self, start=None, end=None):
+        """ Lines of the blocks overlapping the window, one block in memory at a time """
+        for data in self.iter_blocks(start, end):
+            yield from data.decode('Latin-1').split(self.linesep)[:-1]
@@ -0,0 +1,87 @@
+import hashlib
+import os
+
+import pandas as pd
+from pyarrow import feather
+
+from adrena import AdrenaTrack
+from columnar_parser import PARSER_VERSION
+from instrumentation import count, stage
+from track_schema import SCHEMA_VERSION, compact_track
+
+# Parsed tracks are kept as uncompressed Feather files, so a hit is a memory-mapped read instead of a parse.
+# A file is keyed by the hash of the source track, the field map, parser and schema versions,
+# so a new parser or field map never picks up stale results. Least recently used files go first
+# when the cache grows over max_bytes.
+
+
+class TrackCache:
+
+    def __init__(self, directory: str = os.path.join("downloaded_files", ".cache"), max_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hashes = dict()  # path -> (size, mtime, digest), saves rehashing unchanged files
+        os.makedirs(self.directory, exist_ok=True)
+
+    def file_hash(self, file_name: str) -> str:
+        stat = os.stat(file_name)
+        known = self.hashes.get(file_name)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        digest = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        self.hashes[file_name] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+    def key(self, file_name: str, field_map_version) -> str:
+        return f"{self.file_hash(file_name)}_f{field_map_version}_p{PARSER_VERSION}_s{SCHEMA_VERSION}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.feather')
+
+    def load(self, key: str) -> pd.DataFrame | None:
+        path = self.path(key)
+        try:
+            with stage('cache_load'):
+                table = feather.read_table(path, memory_map=True)
+        except (FileNotFoundError, OSError):
+            count('cache_misses')
+            return None
+        count('cache_hits')
+        os.utime(path)  # mark as recently used
+        return table.to_pandas()
+
+    def store(self, key: str, df: pd.DataFrame):
+        path = self.path(key)
+        tmp_path = path + '.tmp'
+        with stage('cache_store'):
+            feather.write_feather(df, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.feather'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def parse(self, file_name: str) -> pd.DataFrame:
+        """ Parsed track in the compact schema from the cache, the file is parsed and stored on a miss """
+        with AdrenaTrack(file_name, stream=True, verbose=False) as track:
+            key = self.key(file_name, track.field_map_version)
+            df = self.load(key)
+            if df is None:
+                df = track.columnar_parsing()
+                with stage('compact'):
+                    df = compact_track(df, track.int_fields)
+                self.store(key, df)
+        return df
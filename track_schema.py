@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from field_maps import INT_FIELDS
+from timestamps import to_datetime64
+
+# Compact dtypes for parsed tracks.
+# Sensor channels are float32, lat/lon stay float64 (float32 is about half a metre off), the int fields are
+# the smallest nullable integer that holds them and the GPS status fields are categorical.
+# utc_datetime (datetime64[ns]) is the only time column, the per-row date and time objects are dropped and
+# the local time is kept as its offset to UTC in minutes.
+
+# Bump when the compact schema changes, cached and live tracks of older versions are then rebuilt
+SCHEMA_VERSION = 1
+
+POSITION_FIELDS = ('lat', 'lon')
+STATUS_FIELDS = ('pos_quality', 'pos_integrity', 'sdgps_status', 'gps_fix_type')
+TIME_FIELDS = ('utc_date', 'utc_time', 'local_date', 'local_time')
+
+
+def small_int_dtype(values: np.ndarray) -> str:
+    """ Smallest nullable integer dtype for the values (NaN for missing) """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return 'Int8'
+    low, high = values.min(), values.max()
+    for dtype in ('Int8', 'Int16', 'Int32'):
+        info = np.iinfo(dtype.lower())
+        if info.min <= low and high <= info.max:
+            return dtype
+    return 'Int64'
+
+
+def compact_column(name: str, series: pd.Series, int_fields: tuple = INT_FIELDS) -> pd.Series:
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(object)
+    values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    if name in int_fields and np.array_equal(values, np.round(values), equal_nan=True):
+        compact = pd.Series(values, index=series.index).astype(small_int_dtype(values))
+        return compact.astype('category') if name in STATUS_FIELDS else compact
+    if name in POSITION_FIELDS:
+        return pd.Series(values, index=series.index)
+    return pd.Series(values.astype(np.float32), index=series.index)
+
+
+def compact_track(df: pd.DataFrame, int_fields: tuple = INT_FIELDS) -> pd.DataFrame:
+    """ Track in the compact schema, columns in the same order """
+    utc = df['utc_datetime'].to_numpy(dtype='datetime64[ns]') if 'utc_datetime' in df.columns else \
+        to_datetime64(df['utc_date'].to_numpy(), df['utc_time'].to_numpy())
+    data = dict()
+    for name in df.columns:
+        if name == 'local_date' and 'local_time' in df.columns:
+            local = to_datetime64(df['local_date'].to_numpy(), df['local_time'].to_numpy())
+            offset = (local - utc) / np.timedelta64(1, 'm')
+            data['local_offset'] = pd.Series(np.round(offset), index=df.index).astype('Int16')
+        elif name == 'utc_datetime':
+            data[name] = pd.Series(utc, index=df.index)
+        elif name not in TIME_FIELDS:
+            data[name] = compact_column(name, df[name], int_fields)
+    if 'utc_datetime' not in data:
+        data['utc_datetime'] = pd.Series(utc, index=df.index)
+    return pd.DataFrame(data, index=df.index)
+
+
+def concat_tracks(frames: list, int_fields: tuple = INT_FIELDS) -> pd.DataFrame:
+    """ pd.concat of compact tracks that keeps the compact dtypes, e.g. of columns missing in some frames """
+    df = pd.concat(frames, ignore_index=True)
+    for name in df.columns:
+        dtypes = set(str(frame[name].dtype) for frame in frames if name in frame.columns)
+        if len(dtypes) > 1 or str(df[name].dtype) not in dtypes:
+            df[name] = compact_column(name, df[name], int_fields) if name != 'local_offset' else \
+                df[name].astype('Int16')
+    return df
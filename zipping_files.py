@@ -1,76 +1,294 @@
-# SuperFastPython.com
-# create a zip file and add files concurrently with threads
+# Archive the track logs with all cores.
+# Worker processes compress, the calling process reads the files and is the only writer of the archive.
+# deflate is compressed in chunks like pigz: every chunk is a raw deflate block ending on a byte boundary
+# (sync flush, the last one finished) primed with the 32 KiB before it, so the chunks joined are one valid
+# deflate stream. The CRC is computed by the reader, the writer puts the compressed bytes into the zip as is.
+# bzip2 and lzma members can not be split that way, they are compressed one member per worker into a temporary
+# file next to the archive, which the writer copies in chunks.
+# At most max_pending chunks (or members) are in flight, so memory stays bounded whatever the file sizes.
+import bz2
+import io
+import lzma
 import os
+import struct
 import sys
+import tempfile
+import zlib
 from os import listdir
 from os.path import join
-from zipfile import ZipFile
-from zipfile import ZIP_DEFLATED, ZIP_BZIP2
+from zipfile import ZipFile, ZipInfo
+from zipfile import ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, ZIP64_LIMIT
 import gzip
-from threading import Lock
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 
 import dif_func as dif_func
+from track_blocks import EXTENSION, write_track_blocks
 
+CHUNK_SIZE = 1024 * 1024
+WINDOW_SIZE = 32 * 1024
+# zstd has no zipfile support before Python 3.14
+METHODS = {'deflate': ZIP_DEFLATED, 'bzip2': ZIP_BZIP2, 'lzma': ZIP_LZMA}
+DEFAULT_LEVELS = {ZIP_DEFLATED: 6, ZIP_BZIP2: 9, ZIP_LZMA: 6}
 
-# load the file as a string then add it to the zip in a thread safe manner
-def add_file_to_zip(lock, handle, filepath):
-    # load the data as a string
-    filename = os.path.split(filepath)[1]
-    with open(filepath, 'r') as file_handle:
-        data = file_handle.read()
-    # add data to zip
-    with lock:
-        handle.writestr(filename, data)
-    # report progress
-    print(f'.added {filename}')
 
+def compress_type_of(method) -> int:
+    if method in METHODS.values():
+        return method
+    if method not in METHODS:
+        raise ValueError(f"Unknown compression {method}, use one of {', '.join(METHODS)}")
+    return METHODS[method]
+
+
+def deflate_chunk(data: bytes, level: int, window: bytes, last: bool) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=window) if window else \
+        zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# ZipFile has no API to write compressed data as is, and lzma none to encode the properties of a zip lzma
+# member. The private names of both used for it are all in the functions below, raw_members_supported()
+# checks them, on a Python where they changed zip_to_one writes the archive with ZipFile alone.
+ZIPFILE_INTERNALS = ('_writecheck', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+LZMA_INTERNALS = ('_encode_filter_properties', '_decode_filter_properties')
+
+
+def raw_members_supported() -> bool:
+    with ZipFile(io.BytesIO(), 'w') as handle:
+        zipfile_ok = all(hasattr(handle, name) for name in ZIPFILE_INTERNALS)
+    return zipfile_ok and all(hasattr(lzma, name) for name in LZMA_INTERNALS)
+
+
+def lzma_member_compressor(level: int) -> tuple:
+    """ (header, compressor) of a zip lzma member: version 9.4, size of the properties, properties, then the
+    raw LZMA1 stream with end marker """
+    props = lzma._encode_filter_properties({'id': lzma.FILTER_LZMA1, 'preset': level})
+    compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[
+        lzma._decode_filter_properties(lzma.FILTER_LZMA1, props)])
+    return struct.pack('<BBH', 9, 4, len(props)) + props, compressor
+
+
+def start_raw_member(handle: ZipFile, zinfo: ZipInfo, zip64: bool):
+    """ What ZipFile.open(zinfo, 'w') does, without the compressor """
+    handle.fp.seek(handle.start_dir)
+    zinfo.header_offset = handle.fp.tell()
+    handle._writecheck(zinfo)
+    handle._didModify = True
+    handle.fp.write(zinfo.FileHeader(zip64))
+
+
+def finish_raw_member(handle: ZipFile, zinfo: ZipInfo, zip64: bool):
+    """ What closing the member opened by ZipFile.open(zinfo, 'w') does: final header and directory entry """
+    handle.start_dir = handle.fp.tell()
+    handle.fp.seek(zinfo.header_offset)
+    handle.fp.write(zinfo.FileHeader(zip64))
+    handle.fp.seek(handle.start_dir)
+    handle.filelist.append(zinfo)
+    handle.NameToInfo[zinfo.filename] = zinfo
+
+
+def compress_member(filepath: str, compress_type: int, level: int, spool_dir: str) -> tuple:
+    """ (crc, size, path of the compressed data) of a whole file, in the format zipfile expects for compress_type.
+    The compressed data goes to a temporary file in spool_dir, the caller removes it """
+    if compress_type == ZIP_BZIP2:
+        compressor = bz2.BZ2Compressor(level)
+        header = b''
+    else:
+        header, compressor = lzma_member_compressor(level)
+    crc = 0
+    size = 0
+    with open(filepath, 'rb') as file_handle, \
+            tempfile.NamedTemporaryFile('wb', dir=spool_dir, suffix='.zpart', delete=False) as spool:
+        spool.write(header)
+        for data in iter(lambda: file_handle.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            spool.write(compressor.compress(data))
+        spool.write(compressor.flush())
+    return crc, size, spool.name
+
+
+class ParallelZip:
+    """ Zip archive written by one process from data compressed in worker processes """
+
+    def __init__(self, zip_path: str, method='deflate', level: int | None = None, jobs: int | None = None,
+                 chunk_size: int = CHUNK_SIZE, max_pending: int | None = None):
+        self.compress_type = compress_type_of(method)
+        self.level = DEFAULT_LEVELS[self.compress_type] if level is None else level
+        self.jobs = jobs or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * self.jobs
+        self.pending = deque()  # (zinfo, future, first, last) in archive order
+        self.zip64_members = dict()  # id(zinfo) -> zip64 header of the members started and not finished
+        if not raw_members_supported():
+            raise RuntimeError("zipfile or lzma internals changed, ParallelZip can not write on this Python")
+        self.spool_dir = os.path.dirname(os.path.abspath(zip_path))
+        self.handle = ZipFile(zip_path, 'w', compression=self.compress_type)
+        self.exe = ProcessPoolExecutor(self.jobs)
+
+    def __enter__(self):
+        return self
 
-def zip_file(filepath, folder, type_compress=ZIP_DEFLATED):
-    # load the data as a string
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, filepath: str, arcname: str | None = None):
+        # file_size is the size at this point, a log still written to grows. It is set again from the bytes
+        # actually read before the member is finished
+        zinfo = ZipInfo.from_file(filepath, arcname or os.path.split(filepath)[1])
+        zinfo.compress_type = self.compress_type
+        if self.compress_type == ZIP_DEFLATED:
+            self.queue_chunks(zinfo, filepath)
+        else:
+            self.queue(zinfo, self.exe.submit(compress_member, filepath, self.compress_type, self.level,
+                                              self.spool_dir), True, True)
+        print(f'.added {zinfo.filename}')
+
+    def queue_chunks(self, zinfo: ZipInfo, filepath: str):
+        crc = 0
+        size = 0
+        window = b''
+        first = True
+        with open(filepath, 'rb') as file_handle:
+            data = file_handle.read(self.chunk_size)
+            while True:
+                next_data = file_handle.read(self.chunk_size) if data else b''
+                last = not next_data
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                if last:
+                    zinfo.CRC, zinfo.file_size = crc, size
+                self.queue(zinfo, self.exe.submit(deflate_chunk, data, self.level, window, last), first, last)
+                if last:
+                    break
+                window = (window + data)[-WINDOW_SIZE:]
+                data, first = next_data, False
+
+    def queue(self, zinfo: ZipInfo, future, first: bool, last: bool):
+        self.pending.append((zinfo, future, first, last))
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+
+    def write_next(self):
+        zinfo, future, first, last = self.pending.popleft()
+        if self.compress_type == ZIP_DEFLATED:
+            data = future.result()
+            if first:
+                self.start_member(zinfo)
+            self.handle.fp.write(data)
+            zinfo.compress_size += len(data)
+        else:
+            zinfo.CRC, zinfo.file_size, spool_path = future.result()
+            try:
+                self.start_member(zinfo)
+                with open(spool_path, 'rb') as spool:
+                    for data in iter(lambda: spool.read(CHUNK_SIZE), b''):
+                        self.handle.fp.write(data)
+                        zinfo.compress_size += len(data)
+            finally:
+                os.remove(spool_path)
+        if last:
+            self.finish_member(zinfo)
+
+    @staticmethod
+    def zip64(zinfo: ZipInfo) -> bool:
+        return zinfo.file_size * 1.05 > ZIP64_LIMIT
+
+    def start_member(self, zinfo: ZipInfo):
+        zinfo.compress_size = 0
+        if not hasattr(zinfo, 'CRC'):
+            zinfo.CRC = 0  # the reader is still on this file, the header is written again at the end
+        zinfo.flag_bits = 0x02 if zinfo.compress_type == ZIP_LZMA else 0x00  # lzma: stream has an end marker
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16
+        # The header is written again at the end with the same layout, so ZIP64 is decided here once
+        zip64 = self.zip64(zinfo)
+        self.zip64_members[id(zinfo)] = zip64
+        start_raw_member(self.handle, zinfo, zip64)
+
+    def finish_member(self, zinfo: ZipInfo):
+        zip64 = self.zip64_members.pop(id(zinfo))
+        if not zip64 and max(zinfo.compress_size, zinfo.file_size) > ZIP64_LIMIT:
+            raise RuntimeError(f"{zinfo.filename}: too large for a zip without ZIP64")
+        finish_raw_member(self.handle, zinfo, zip64)
+
+    def close(self):
+        try:
+            while self.pending:
+                self.write_next()
+        finally:
+            self.exe.shutdown(cancel_futures=True)
+            self.handle.close()
+            # Members compressed but not written after an error
+            for _, future, _, _ in self.pending:
+                if self.compress_type != ZIP_DEFLATED and not future.cancelled() and future.exception() is None:
+                    os.remove(future.result()[2])
+
+
+def zip_file(filepath, folder, type_compress=ZIP_DEFLATED, level=None):
+    # one archive per file, the file is streamed into it
     if type_compress == ZIP_BZIP2:
         file_ext = ".bz2"
     else:
         file_ext = ".zip"
-    with open(filepath, 'rb') as file_handle:
-        data = file_handle.read()
-    # add data to zip
     source_folder, name = os.path.split(filepath)
 
-    with ZipFile(os.path.join(source_folder, folder, name) + file_ext, "w", compression=type_compress) as file_zip:
-        file_zip.writestr(name, data)
+    with ZipFile(os.path.join(source_folder, folder, name) + file_ext, "w", compression=type_compress,
+                 compresslevel=level) as file_zip:
+        file_zip.write(filepath, name)
     # report progress
     print(f'.added {name}')
 
 
 # create a zip file
-def zip_to_one(path, zip_file_name):
+def zip_to_one(path, zip_file_name, method='deflate', level=None, jobs=None):
+    zip_path = join(path, zip_file_name) + '.zip'
     # list all files to add to the zip
-    files = [join(path, f) for f in listdir(path) if os.path.isfile(join(path, f))]
-    # create lock for adding files to the zip
-    lock = Lock()
-    # open the zip file
-    with ZipFile(join(path, zip_file_name)+ '.zip', 'w', compression=ZIP_DEFLATED) as handle:
-        # create the thread pool
-        with ThreadPoolExecutor(100) as exe:
-            # add all files to the zip archive
-            _ = [exe.submit(add_file_to_zip, lock, handle, f) for f in files]
+    files = [join(path, f) for f in sorted(listdir(path)) if os.path.isfile(join(path, f))
+             and join(path, f) != zip_path]
+    if not raw_members_supported():
+        with ZipFile(zip_path, 'w', compression=compress_type_of(method), compresslevel=level) as handle:
+            for f in files:
+                handle.write(f, os.path.split(f)[1])
+                print(f'.added {os.path.split(f)[1]}')
+        return
+    with ParallelZip(zip_path, method, level, jobs) as handle:
+        for f in files:
+            handle.add(f)
 
 
 @dif_func.benchmark
-def zip_to_many(path, subfolder, type_compress=ZIP_DEFLATED, thread_num=1):
+def zip_to_many(path, subfolder, type_compress=ZIP_DEFLATED, jobs=None, level=None):
     # list all files to add to the zip
-    try:
-        os.mkdir(path+'\\'+subfolder)
-    except OSError:
-        pass
+    os.makedirs(join(path, subfolder), exist_ok=True)
     files = [join(path, f) for f in listdir(path) if os.path.isfile(join(path, f))]
-    # for f in files:
-    #     zip_file(f, path+'\\'+subfolder, type_compress)
-    with ThreadPoolExecutor(thread_num) as exe:
-        # add all files to the zip archive
-        _ = [exe.submit(zip_file, f, path+'\\'+subfolder, type_compress) for f in files]
+    # every archive is written by the process that compresses it
+    with ProcessPoolExecutor(jobs) as exe:
+        futures = [exe.submit(zip_file, f, subfolder, compress_type_of(type_compress), level) for f in files]
+        for future in futures:
+            future.result()
+
+
+def track_to_blocks(filepath, folder, block_seconds=300, level=6):
+    # indexed container of a .trz/.jtz/.trc track, the track is streamed through line by line
+    source_folder, name = os.path.split(filepath)
+    binary = gzip.open(filepath, 'rb') if name.endswith(('trz', 'jtz')) else open(filepath, 'rb')
+    with io.TextIOWrapper(binary, encoding='Latin-1', newline='\n') as text_file:
+        lines = (line[:-1] if line.endswith('\n') else line for line in text_file)
+        write_track_blocks(lines, os.path.join(source_folder, folder, os.path.splitext(name)[0] + EXTENSION),
+                           block_seconds, level)
+    print(f'.added {name}')
+
+
+@dif_func.benchmark
+def blocks_to_many(path, subfolder, block_seconds=300, jobs=None):
+    os.makedirs(join(path, subfolder), exist_ok=True)
+    files = [join(path, f) for f in listdir(path) if f.endswith(('.trz', '.jtz', '.trc'))]
+    with ProcessPoolExecutor(jobs) as exe:
+        futures = [exe.submit(track_to_blocks, f, subfolder, block_seconds) for f in files]
+        for future in futures:
+            future.result()
 
 
 def un_gzip_to_memory(zip_path):
@@ -83,10 +301,13 @@ def un_gzip_to_memory(zip_path):
 def com_help():
     print("Using zipping_files:")
     print("zipping_files path command parameter [option1] [option2]")
-    print("commands: 'one' or 'many'")
+    print("commands: 'one', 'many' or 'blocks'")
     print("if command is 'one' parameter is zip file name wo extension")
     print("if command is 'many' parameter is subfolder name")
-    print("option1 - zip algoritm 1-")
+    print(f"if command is 'blocks' parameter is subfolder name for the indexed {EXTENSION} tracks, "
+          f"option1 - seconds of records per block (300)")
+    print(f"option1 - zip algoritm: {', '.join(METHODS)}, 'deflate' for 'one' and 'bzip2' for 'many' by default")
+    print("option2 - compression level, 1 (fast) - 9 (best)")
 
 
 def main():
@@ -94,10 +315,14 @@ def main():
         path = sys.argv[1]
         command = sys.argv[2]
         parameter = sys.argv[3]
+        method = sys.argv[4] if len(sys.argv) > 4 else None
+        level = int(sys.argv[5]) if len(sys.argv) > 5 else None
         if command == "one":
-            zip_to_one(path, parameter)
+            zip_to_one(path, parameter, method or 'deflate', level)
         elif command == "many":
-            zip_to_many(path, parameter, ZIP_BZIP2, 50)
+            zip_to_many(path, parameter, method or 'bzip2', level=level)
+        elif command == "blocks":
+            blocks_to_many(path, parameter, int(method or 300))
         else:
             com_help()
     else: